@@ -0,0 +1,371 @@
+"""Module to benchmark the import cost of the generated pyaz package."""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+
+class Constants:
+    """Static class for constants."""
+
+    COMMAND_ROOT = "pyaz"  # the root name of the command path
+    OUTPUT_DIR_NAME = "output"  # the name of the output folder of the generated code
+    TIME_METRICS = ["cold_import_seconds", "warm_import_seconds"]  # the timed metrics
+    MEMORY_METRICS = ["memory_bytes"]  # the measured memory metrics
+    MIN_TIME_DELTA = 0.005  # seconds of noise allowed over a baseline regardless of tolerance
+    MIN_MEMORY_DELTA = 65536  # bytes of noise allowed over a baseline regardless of tolerance
+
+
+# script run in a fresh interpreter to time the import of a module
+# __import__ is used as -X importtime doesn't trace importlib.import_module itself
+TIME_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+__import__(sys.argv[1])
+print(json.dumps(time.perf_counter() - start))
+"""
+
+# script run in a fresh interpreter to trace the memory allocated importing a module
+# reporting the memory allocated by the files under a folder
+MEMORY_SCRIPT = """
+import importlib, json, sys, tracemalloc
+tracemalloc.start()
+importlib.import_module(sys.argv[1])
+_, peak = tracemalloc.get_traced_memory()
+statistics = tracemalloc.take_snapshot().statistics("filename")
+files = [
+    [stat.traceback[0].filename, stat.size]
+    for stat in statistics
+    if stat.traceback[0].filename.startswith(sys.argv[2])
+]
+print(json.dumps({"peak": peak, "files": files}))
+"""
+
+
+def get_groups(output_dir):
+    """Return the names of the top-level command groups of the generated package."""
+    root_dir = os.path.join(output_dir, Constants.COMMAND_ROOT)
+    return sorted(
+        name
+        for name in os.listdir(root_dir)
+        if os.path.isfile(os.path.join(root_dir, name, "__init__.py"))
+    )
+
+
+def get_size(path):
+    """Return the number of files and bytes generated under path."""
+    files = 0
+    size = 0
+    for directory, dirnames, filenames in os.walk(path):
+        dirnames[:] = [dirname for dirname in dirnames if dirname != "__pycache__"]
+        for filename in filenames:
+            files += 1
+            size += os.path.getsize(os.path.join(directory, filename))
+    return files, size
+
+
+def clear_bytecode(output_dir):
+    """Remove the bytecode cached for the generated package."""
+    root_dir = os.path.join(output_dir, Constants.COMMAND_ROOT)
+    for directory, dirnames, _ in os.walk(root_dir):
+        if "__pycache__" in dirnames:
+            dirnames.remove("__pycache__")
+            shutil.rmtree(os.path.join(directory, "__pycache__"))
+
+
+def check_bytecode(output_dir):
+    """Raise RuntimeError if no bytecode was cached for the generated package."""
+    root_dir = os.path.join(output_dir, Constants.COMMAND_ROOT)
+    if not os.path.isdir(os.path.join(root_dir, "__pycache__")):
+        raise RuntimeError(
+            f"no bytecode was cached under {root_dir}, the warm imports would be cold too"
+        )
+
+
+def _run_python(output_dir, args):
+    """
+    Run python with args in a fresh interpreter importing from output_dir.
+
+    PYTHONDONTWRITEBYTECODE is removed from the environment, as the warm imports
+    rely on the bytecode cached by the cold import.
+    """
+    env = dict(os.environ, PYTHONPATH=output_dir)
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    return subprocess.run(
+        [sys.executable] + args,
+        cwd=output_dir,
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        check=True,
+    )
+
+
+def _parse_importtime(stderr):
+    """
+    Return the self and cumulative import times of each module from -X importtime output.
+
+    The times are in seconds, keyed by module name as [self, cumulative].
+    """
+    modules = {}
+    for line in stderr.decode("utf-8").splitlines():
+        # import time: self [us] | cumulative | imported package
+        if line.startswith("import time:") and "|" in line:
+            self_time, cumulative, name = line[len("import time:"):].split("|")
+            if self_time.strip().isdigit():
+                modules[name.strip()] = [int(self_time) / 1_000_000, int(cumulative) / 1_000_000]
+    return modules
+
+
+def _run_import(output_dir, module):
+    """Return the import time of a module in a fresh interpreter, and of each module it imports."""
+    output = _run_python(output_dir, ["-X", "importtime", "-c", TIME_SCRIPT, module])
+    return json.loads(output.stdout), _parse_importtime(output.stderr)
+
+
+def run_imports(output_dir, module, repeat=3):
+    """
+    Return the runs importing a module of the generated package, timed and traced.
+
+    The cold import runs without the generated package's bytecode cached, so its
+    modules are compiled, and the warm imports run repeat times with the bytecode
+    cached. The memory is traced in a separate run.
+    """
+    output_dir = os.path.abspath(output_dir)
+
+    clear_bytecode(output_dir)
+    cold = _run_import(output_dir, module)
+    check_bytecode(output_dir)
+
+    warm = [_run_import(output_dir, module) for _ in range(repeat)]
+
+    memory = json.loads(
+        _run_python(
+            output_dir, ["-c", MEMORY_SCRIPT, module, output_dir + os.path.sep]
+        ).stdout
+    )
+    return {"module": module, "cold": cold, "warm": warm, "memory": memory}
+
+
+def get_result(output_dir, runs, module, top=10):
+    """
+    Return the import cost of a module from runs importing it or the whole package.
+
+    The pyaz package is measured by its total import time and the peak memory of
+    the import. Its groups are measured by their cumulative entry in -X importtime,
+    covering their own submodules but not the modules imported before them, and by
+    the memory traced to their own files. A group imported on its own imports pyaz
+    first, within its entry, so the time of pyaz is taken out of it.
+    """
+    output_dir = os.path.abspath(output_dir)
+    module_dir = os.path.join(output_dir, *module.split(".")) + os.path.sep
+
+    # the warm run importing the fastest gives the slowest modules
+    warm_seconds, warm_modules = min(runs["warm"], key=lambda run: run[0])
+    files = [
+        [filename, size]
+        for filename, size in runs["memory"]["files"]
+        if filename.startswith(module_dir)
+    ]
+
+    if module == Constants.COMMAND_ROOT:
+        cold_seconds = runs["cold"][0]
+        memory = runs["memory"]["peak"]
+    else:
+        cold_seconds = _get_own_seconds(runs["cold"][1], module, runs["module"])
+        warm_seconds = min(
+            _get_own_seconds(modules, module, runs["module"]) for _, modules in runs["warm"]
+        )
+        memory = sum(size for _, size in files)
+
+    # only report the generated modules, not the standard library
+    slowest = sorted(
+        [
+            [name, times[0]]
+            for name, times in warm_modules.items()
+            if name == module or name.startswith(module + ".")
+        ],
+        key=lambda item: item[1],
+        reverse=True,
+    )[:top]
+    largest = [[os.path.relpath(filename, output_dir), size] for filename, size in files[:top]]
+
+    return {
+        "cold_import_seconds": cold_seconds,
+        "warm_import_seconds": warm_seconds,
+        "memory_bytes": memory,
+        "slowest_modules": slowest,
+        "largest_modules": largest,
+    }
+
+
+def _get_own_seconds(modules, module, imported_module):
+    """Return the cumulative import time of a module, less pyaz's if it imported pyaz."""
+    seconds = modules[module][1]
+    if module == imported_module:
+        seconds -= modules[Constants.COMMAND_ROOT][1]
+    return seconds
+
+
+def measure(output_dir, groups=None, repeat=3, top=10):
+    """
+    Return the import cost of the pyaz package and of each top-level group, by module.
+
+    When pyaz imports every group up front, importing a group alone costs as much
+    as importing pyaz, so each group's cost is taken from the import of pyaz. Only
+    packages generated with --lazy-imports have their groups imported on their own.
+    """
+    results = {}
+
+    print(f"measuring import of: {Constants.COMMAND_ROOT}")
+    root_runs = run_imports(output_dir, Constants.COMMAND_ROOT, repeat)
+
+    modules = [Constants.COMMAND_ROOT] + [
+        f"{Constants.COMMAND_ROOT}.{group}" for group in (groups or get_groups(output_dir))
+    ]
+    for module in modules:
+        if module == Constants.COMMAND_ROOT:
+            runs = root_runs
+        elif module in root_runs["cold"][1]:
+            print(f"measuring import of: {module}, within {Constants.COMMAND_ROOT}")
+            runs = root_runs
+        else:
+            print(f"measuring import of: {module}")
+            runs = run_imports(output_dir, module, repeat)
+
+        result = get_result(output_dir, runs, module, top)
+        result["files"], result["bytes"] = get_size(os.path.join(output_dir, *module.split(".")))
+        results[module] = result
+
+    return results
+
+
+def check_budgets(results, budgets):
+    """
+    Return the failures of the results exceeding their budgets.
+
+    Budgets are keyed by module, with "*" as the budget of the modules not listed,
+    e.g. {"pyaz": {"warm_import_seconds": 1.0}, "*": {"memory_bytes": 10000000}}
+    """
+    failures = []
+    for module, result in results.items():
+        budget = budgets.get(module, budgets.get("*", {}))
+        for metric, limit in budget.items():
+            if result[metric] > limit:
+                failures.append(f"{module} {metric} {result[metric]} is over budget {limit}")
+    return failures
+
+
+def compare_baseline(results, baseline, tolerance=0.2):
+    """Return the failures of the results regressing more than tolerance over the baseline."""
+    failures = []
+    for module, result in results.items():
+        if module not in baseline:
+            continue
+        for metric in Constants.TIME_METRICS + Constants.MEMORY_METRICS:
+            if metric in Constants.TIME_METRICS:
+                min_delta = Constants.MIN_TIME_DELTA
+            else:
+                min_delta = Constants.MIN_MEMORY_DELTA
+
+            limit = baseline[module][metric] + max(
+                baseline[module][metric] * tolerance, min_delta
+            )
+            if result[metric] > limit:
+                failures.append(
+                    f"{module} {metric} {result[metric]} regressed over"
+                    f" baseline {baseline[module][metric]}"
+                )
+    return failures
+
+
+def print_report(results, top=10):
+    """Print the import cost of each module, and the slowest and largest generated modules."""
+    print(f"{'module':<40} {'cold s':>8} {'warm s':>8} {'memory':>12} {'files':>6} {'bytes':>12}")
+    for module, result in results.items():
+        print(
+            f"{module:<40} {result['cold_import_seconds']:>8.3f}"
+            f" {result['warm_import_seconds']:>8.3f} {result['memory_bytes']:>12}"
+            f" {result['files']:>6} {result['bytes']:>12}"
+        )
+
+    root = results.get(Constants.COMMAND_ROOT)
+    if root:
+        print(f"\nslowest modules importing {Constants.COMMAND_ROOT}:")
+        for name, seconds in root["slowest_modules"][:top]:
+            print(f"  {name:<60} {seconds:>8.4f}")
+        print(f"\nlargest modules importing {Constants.COMMAND_ROOT}:")
+        for name, size in root["largest_modules"][:top]:
+            print(f"  {name:<60} {size:>10}")
+
+
+def main(argv=None):
+    """Benchmark the import cost of the generated package, returning the exit code."""
+    args = _parse_args(argv)
+
+    if args.generate:
+        import generate_code  # pylint: disable=import-outside-toplevel
+        generate_code.main()
+
+    results = measure(args.output_dir, args.groups, args.repeat, args.top)
+    print_report(results, args.top)
+
+    failures = []
+    if args.budgets:
+        with open(args.budgets, mode="r", encoding="utf-8") as file:
+            failures += check_budgets(results, json.load(file))
+
+    if args.baseline and args.update_baseline:
+        with open(args.baseline, mode="w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+    elif args.baseline and os.path.exists(args.baseline):
+        with open(args.baseline, mode="r", encoding="utf-8") as file:
+            failures += compare_baseline(results, json.load(file), args.tolerance)
+
+    for failure in failures:
+        print(f"FAILED: {failure}")
+    return 1 if failures else 0
+
+
+def _parse_args(argv):
+    """Parse the command line options of the benchmark."""
+    current_dir = os.path.dirname(os.path.realpath(__file__))
+    parser = argparse.ArgumentParser(description="Benchmark the import cost of pyaz.")
+    parser.add_argument(
+        "--output-dir",
+        default=os.path.join(current_dir, Constants.OUTPUT_DIR_NAME),
+        help="the folder containing the generated pyaz package",
+    )
+    parser.add_argument(
+        "--generate", action="store_true", help="generate the code before benchmarking"
+    )
+    parser.add_argument(
+        "--groups", nargs="+", help="the top-level groups to measure, by default all"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="the number of warm imports to time"
+    )
+    parser.add_argument(
+        "--top", type=int, default=10, help="the number of slowest and largest modules"
+    )
+    parser.add_argument("--budgets", help="json file of the budgets by module")
+    parser.add_argument("--baseline", help="json file of the baseline results")
+    parser.add_argument(
+        "--update-baseline",
+        action="store_true",
+        help="store the results as the baseline instead of comparing",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="the fraction by which results may exceed the baseline",
+    )
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
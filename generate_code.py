@@ -1,5 +1,7 @@
 """Module to generate code for az-cli-py."""
 
+import argparse
+import json
 import os
 import keyword
 import shutil
@@ -12,6 +14,13 @@ class Constants:
     COMMAND_ROOT = "pyaz"  # the root name of the command path
     OUTPUT_DIR_NAME = "output"  # the name of the output folder for generating code
     UTILS_FILE_NAME = "pyaz_utils.py"  # the name of module with utilities
+    HELP_INDEX_FILE_NAME = "_help_index.jsonl"  # the name of the help index of lean modules
+    DISPATCH_INDEX_FILE_NAME = "_dispatch_index.jsonl"  # the name of the command dispatch index
+    VALIDATION_TYPES = {int: "int", float: "float"}  # the argument types checked client-side
+    IDS_BATCH_VERBS = ["show", "delete"]  # the verbs whose calls with --ids can be batched
+    # the flags of commands returning their results a page at a time, with the next marker
+    PAGING_FLAGS = ["--marker", "--num-results", "--show-next-marker"]
+    PAGE_SIZE_HELP = "The number of results fetched per page, 1000 by default."
 
 
 def pythonize_name(name: str) -> str:
@@ -92,206 +101,512 @@ def get_commands():
     return command_dict
 
 
-def generate_code(base_dir):
+def generate_code(base_dir, streaming=False, lean=False, lazy_imports=False):
     """
     Generate code for pyaz from the az cli command table.
 
     Create a folder structure starting from the base_dir based on the hierarchy of
     the commands, with a folder for each command containing an __init__ module
     that contains the "verb" functions (if any) associated with that command
+
+    When streaming is set the command groups are processed one at a time and the
+    knack command objects, their loaded arguments, the cached help and the main
+    loader's merged argument registries are released as soon as the group's module
+    is written. The per-module loaders and their own registries stay loaded, as the
+    commands of a module can span several groups.
+
+    When lean is set the modules are written without docstrings, the docs go to an
+    __init__.pyi stub next to each module for IDEs and to a help index that
+    pyaz.help() loads on demand.
+
+    When lazy_imports is set the modules import their subcommands on first access
+    rather than importing the whole tree up front.
+
+    A dispatch index of all the commands is also written for pyaz.call(). The
+    choices, number of values, types and required arguments that pyaz checks
+    before calling az are passed to _call_az by each function that has any.
     """
     commands = get_commands()
 
-    for command_path, command_group in commands.items():
+    # start the indexes from scratch as they are appended to module by module
+    root_dir = os.path.join(base_dir, Constants.COMMAND_ROOT)
+    index_paths = {
+        file_name: os.path.join(root_dir, file_name)
+        for file_name in [
+            Constants.HELP_INDEX_FILE_NAME,
+            Constants.DISPATCH_INDEX_FILE_NAME,
+        ]
+    }
+    os.makedirs(name=root_dir, exist_ok=True)
+    for index_path in index_paths.values():
+        if os.path.exists(index_path):
+            os.remove(index_path)
+
+    for command_path, command_group in _iter_command_groups(commands, streaming):
         print(f"generating code module for: {command_path}")
 
-        # translate the command back into the az syntax so that we can use it to get help
-        az_command = command_path.split(os.path.sep)
-        az_command.pop(0)
-        az_command = " ".join(az_command)
-
-        # get the help for the module
-        module_summary = None
-        module_help = tooling.get_help(az_command)
-        if module_help:
-            module_summary = module_help.get("short-summary", None)
-
         # get the module path and create it if it doesn't exist
         module_dir = os.path.join(base_dir, command_path)
         os.makedirs(name=module_dir, exist_ok=True)
 
+        module = _get_module_code(command_path, command_group, lean, lazy_imports)
+
         # create the module __init__ file that will contain the verb functions
         with open(f"{module_dir}/__init__.py", mode="w", encoding="utf-8") as file:
+            file.write(module.code)
 
-            # add help to the top of the module
-            if module_summary:
-                file.write(f"'''\n{module_summary}\n'''\n")
+        # write the stub and the help index entries carrying the docs
+        if lean:
+            with open(f"{module_dir}/__init__.pyi", mode="w", encoding="utf-8") as file:
+                file.write(module.stub)
+            _append_index(
+                index_paths[Constants.HELP_INDEX_FILE_NAME],
+                [{"name": name, "doc": doc} for name, doc in module.docs.items()],
+            )
 
-            # get the level of depth for this command based on the path separator
-            # add one so that the top-most is level 1
-            command_depth = command_path.count(os.path.sep) + 1
+        # add the module's commands to the dispatch index
+        _append_index(index_paths[Constants.DISPATCH_INDEX_FILE_NAME], module.dispatch)
 
-            # create import_dots to represent level of depth for importing the pyaz_utils
-            import_dots = "." * command_depth
-
-            # write the imports to the top of each module
-            # f.write("import json, subprocess\n")
-            file.write(f"from {import_dots} pyaz_utils import _call_az\n")
+        # release the knack objects and help for the group now that it is written
+        if streaming:
+            for command in command_group.values():
+                tooling.release_command(command.name)
+            tooling.release_help(_get_az_command(command_path))
+            tooling.release_arguments()
 
-            # build list of subcommands and add import statement
-            subcommands = command_group["_subcommands"]
-            if len(subcommands) > 0:
-                file.write(f'from . import {", ".join(sorted(subcommands))}\n\n')
-
-            # del the subcommands list as it is no longer needed
-            del command_group["_subcommands"]
-
-            # for each command verb write a function with a boiler plate format
-            for command_verb, command in command_group.items():
-
-                # placeholder list for the output arguments
-                required_args = []
-                optional_args = []
-                required_arg_names = []
-                optional_arg_names = []
-
-                # get the command object from the command table
-                #command = commands[command_path][command_verb]
-
-                # get the dictionary of arguments for the command
-                arguments = tooling.get_arguments(command)
-
-                # loop through each argument in the arguments dictionary
-                for argument in arguments:
-
-                    # get the argument object
-                    arg = arguments[argument]
-
-                    # create instance of Argument class
-                    output_arg = Argument()
-
-                    # get the options_list which is the options for this argument in the format:
-                    # ['--resource-group', '-g']
-                    options_list = arg.type.settings.get("options_list", [])
-
-                    # if there are options then derive the argument name from the options
-                    if len(options_list) > 0:
-
-                        # remove any non strings from options_list
-                        # when testing, found one option with an object of type
-                        # knack.deprecation.Deprecated object
-                        options_list = [
-                            option for option in options_list if isinstance(option, str)
-                        ]
-
-                        # get the first option from the options list as that is the one we want
-                        # the second option is the shorter one
-                        # and pythonize the name of the argument
-                        name = pythonize_name(options_list[0])
-
-                        if not name.startswith("_") and name not in ["__cmd__", "cmd"]:
-
-                            output_arg.name = name
-
-                            # get the argument's help text
-                            output_arg.help = arg.type.settings.get("help", None)
-
-                            # get the argument's default value
-                            output_arg.default = arg.type.settings.get("default", None)
-
-                            # get whether the argument is required
-                            output_arg.required = arg.type.settings.get(
-                                "required", False
-                            )
-
-                            if output_arg.required:
-                                required_arg_names.append(output_arg.formatted_name())
-                                required_args.append(output_arg)
-                            else:
-                                optional_arg_names.append(output_arg.formatted_name())
-                                optional_args.append(output_arg)
-
-                # sort args by name
-                required_args = sorted(required_args, key=lambda arg: arg.name)
-                optional_args = sorted(optional_args, key=lambda arg: arg.name)
-
-                # build final list of args from sorted required and optional args
-                required_args_formatted = ", ".join(sorted(required_arg_names))
-                optional_args_formatted = ", ".join(sorted(optional_arg_names))
-
-                if required_args and optional_args:
-                    arguments_formatted = (
-                        required_args_formatted + ", " + optional_args_formatted
-                    )
-                elif required_args:
-                    arguments_formatted = required_args_formatted
-                else:
-                    arguments_formatted = optional_args_formatted
-
-                # get help for commmand
-                command_help = tooling.get_help(command.name)
-                if command_help:
-                    short_summary = command_help.get("short-summary", "")
-                else:
-                    short_summary = ""
-
-                function_doc = short_summary
-
-                # combine with arguments
-                # required_args_doc = ""
-                # if len(required_args) > 0:
-                #    for arg in required_args:
-                #        required_args_doc = required_args_doc.
-                if len(required_args) > 0:
-                    required_args_doc = "\n\n    Required Parameters:\n"
-                    required_args_doc += "\n".join(
-                        [f"    - {arg.name} -- {arg.help}" for arg in required_args]
-                    )
-                    function_doc += required_args_doc
-
-                if len(optional_args) > 0:
-                    optional_args_doc = "\n\n    Optional Parameters:\n"
-                    optional_args_doc += "\n".join(
-                        [f"    - {arg.name} -- {arg.help}" for arg in optional_args]
-                    )
-                    function_doc += optional_args_doc
-
-                # write the command verb's function body using the parts
-                # to the command's __init__ module
-                # if help summary then include that
-                function_def = _get_az_function_def(
-                    command.name, command_verb, arguments_formatted, function_doc
-                )
-                file.write(function_def)
 
+def _append_index(index_path, entries):
+    """Append the entries to the index file, one json line each."""
+    with open(index_path, mode="a", encoding="utf-8") as file:
+        for entry in entries:
+            file.write(json.dumps(entry) + "\n")
+
+
+def _iter_command_groups(commands, streaming):
+    """
+    Yield (command_path, command_group) pairs from the commands dictionary.
+
+    When streaming, each group is removed from the dictionary before it is yielded
+    so that nothing else keeps a reference to it once it has been written.
+    """
+    if not streaming:
+        yield from commands.items()
+        return
+
+    while commands:
+        yield commands.popitem()
+
+
+def _get_az_command(command_path):
+    """Translate a command path back into the az syntax, e.g. pyaz/vm/disk -> vm disk."""
+    az_command = command_path.split(os.path.sep)
+    az_command.pop(0)
+    return " ".join(az_command)
+
+
+def _get_module_code(command_path, command_group, lean=False, lazy_imports=False):
+    """
+    Return the Module holding the generated code for a command group.
+
+    The module code leaves out all the docstrings when lean is set,
+    the stub and the docs are always filled in.
+    """
+    module = Module()
+
+    # the dotted name of the module, used to key the help index
+    module_name = command_path.replace(os.path.sep, ".")
+
+    # get the help for the module
+    module_summary = None
+    module_help = tooling.get_help(_get_az_command(command_path))
+    if module_help:
+        module_summary = module_help.get("short-summary", None)
+
+    # add help to the top of the module
+    if module_summary:
+        module.stub += f"'''\n{module_summary}\n'''\n"
+        module.docs[module_name] = module_summary
+        if not lean:
+            module.code += f"'''\n{module_summary}\n'''\n"
+
+    # get the level of depth for this command based on the path separator
+    # add one so that the top-most is level 1
+    command_depth = command_path.count(os.path.sep) + 1
+
+    # create import_dots to represent level of depth for importing the pyaz_utils
+    import_dots = "." * command_depth
+
+    # write the imports to the top of each module
+    module.code += f"from {import_dots} pyaz_utils import _call_az\n"
+
+    # the top-most module also exposes the help for lean modules and call by name
+    if command_depth == 1:
+        module.code += "from . pyaz_utils import call, show_help as help\n"
+        module.stub += "def call(command: str, **kwargs) -> object: ...\n"
+        module.stub += "def help(target: object) -> None: ...\n"
+
+    # build list of subcommands and add import statement
+    # the subcommands list is removed as it is no longer needed
+    subcommands = sorted(command_group.pop("_subcommands"))
+    if len(subcommands) > 0:
+        module.code += _get_subcommands_import(subcommands, import_dots, lazy_imports)
+        module.stub += f'from . import {", ".join(subcommands)}\n\n'
+
+    # for each command verb write a function with a boiler plate format
+    for command_verb, command in command_group.items():
+
+        # get the sorted argument records for the command
+        required_args, optional_args = _get_command_arguments(command)
+
+        # build final list of args from sorted required and optional args
+        arguments_formatted = ", ".join(
+            [arg.formatted_name() for arg in required_args + optional_args]
+        )
+
+        # get help for commmand
+        command_help = tooling.get_help(command.name)
+        if command_help:
+            short_summary = command_help.get("short-summary", "")
+        else:
+            short_summary = ""
+
+        function_doc = _get_function_doc(short_summary, required_args, optional_args)
+
+        # options passed on to _call_az by the function
+        call_options = {}
+
+        # calls with only --ids can be merged into a single az call
+        # only commands whose loaded arguments list --ids qualify, az adds --ids
+        # to the commands with id_part arguments when it runs them, not when loaded
+        if command_verb in Constants.IDS_BATCH_VERBS and any(
+            arg.flag == "--ids" for arg in optional_args
+        ):
+            call_options["ids_batchable"] = True
+
+        # the rules checked before calling az, for the commands that have any
+        validation = _get_validation_entry(command, required_args, optional_args)
+        if validation:
+            call_options["validation"] = validation
+
+        # write the command verb's function body using the parts
+        # if help summary then include that
+        module.code += _get_az_function_def(
+            command.name,
+            command_verb,
+            arguments_formatted,
+            "" if lean else function_doc,
+            call_options,
+        )
+        module.stub += _get_stub_function_def(
+            command_verb, arguments_formatted, function_doc
+        )
+        module.docs[f"{module_name}.{command_verb}"] = function_doc
+
+        # commands returning a page at a time also get a generator of all the results
+        if _is_pageable(optional_args):
+            iter_name, iter_arguments, iter_doc = _get_iter_function_parts(
+                command_verb, short_summary, required_args, optional_args
+            )
+            module.code += _get_az_function_def(
+                command.name,
+                iter_name,
+                iter_arguments,
+                "" if lean else iter_doc,
+                dict(call_options, paginate=True),
+            )
+            module.stub += _get_stub_function_def(iter_name, iter_arguments, iter_doc)
+            module.docs[f"{module_name}.{iter_name}"] = iter_doc
+
+        # the arguments are recorded in the order of the function's signature
+        module.dispatch.append(
+            {
+                "command": command.name,
+                "module": module_name,
+                "function": command_verb,
+                "arguments": [
+                    [arg.name, arg.flag, arg.required]
+                    for arg in required_args + optional_args
+                ],
+                "options": call_options,
+            }
+        )
+
+    return module
+
+
+def _is_pageable(optional_args):
+    """
+    Return whether a command takes a marker and a page size, and can show the next marker.
+
+    Commands without --show-next-marker, like storage file list, aren't pageable as
+    their output has no marker of the next page to follow.
+    """
+    flags = [arg.flag for arg in optional_args]
+    return all(flag in flags for flag in Constants.PAGING_FLAGS)
+
+
+def _get_iter_function_parts(command_verb, short_summary, required_args, optional_args):
+    """
+    Return the (name, arguments, doc) of the iter_ function of a pageable command.
+
+    The iter_ function yields all the results, its paging arguments are replaced
+    by a page_size and _call_az fetches the pages following the markers.
+    """
+    function_name = f"iter_{command_verb}"
+
+    page_size = Argument()
+    page_size.name = "page_size"
+    page_size.help = Constants.PAGE_SIZE_HELP
+    optional_args = [
+        arg for arg in optional_args if arg.flag not in Constants.PAGING_FLAGS
+    ] + [page_size]
+
+    arguments_formatted = ", ".join(
+        [arg.formatted_name() for arg in required_args + optional_args]
+    )
+    function_doc = _get_function_doc(
+        f"{short_summary} Yields the results, fetching them a page at a time.".strip(),
+        required_args,
+        optional_args,
+    )
+    return function_name, arguments_formatted, function_doc
+
+
+def _get_function_doc(short_summary, required_args, optional_args):
+    """Return the docstring of a function from the command summary and its arguments."""
+    function_doc = short_summary
+
+    # combine with arguments
+    if len(required_args) > 0:
+        required_args_doc = "\n\n    Required Parameters:\n"
+        required_args_doc += "\n".join(
+            [f"    - {arg.name} -- {arg.help}" for arg in required_args]
+        )
+        function_doc += required_args_doc
+
+    if len(optional_args) > 0:
+        optional_args_doc = "\n\n    Optional Parameters:\n"
+        optional_args_doc += "\n".join(
+            [f"    - {arg.name} -- {arg.help}" for arg in optional_args]
+        )
+        function_doc += optional_args_doc
+
+    return function_doc
+
+
+def _get_validation_entry(command, required_args, optional_args):
+    """
+    Return the validation rules of a command, None if there is nothing to check.
+
+    The rules are passed to _call_az by the command's function, so that a call only
+    carries the rules of its own command.
+
+    The rules of each argument are only recorded when they constrain its value,
+    and the command's extension, if any, is recorded so its checks can be skipped.
+    Required arguments with a configured default aren't recorded as required, as
+    az fills them in from its config (e.g. az config set defaults.group=...).
+    """
+    rules = {}
+    for arg in required_args + optional_args:
+        rule = {}
+        if arg.choices:
+            rule["choices"] = arg.choices
+        if arg.nargs is not None:
+            rule["nargs"] = arg.nargs
+        if arg.type:
+            rule["type"] = arg.type
+        if rule:
+            rules[arg.name] = rule
+
+    required = [arg.name for arg in required_args if not arg.configured_default]
+    if not rules and not required:
+        return None
+
+    entry = {
+        "required": required,
+        "arguments": rules,
+    }
+
+    # commands loaded from an extension carry the name of their extension
+    extension = getattr(getattr(command, "command_source", None), "extension_name", None)
+    if extension:
+        entry["extension"] = extension
+    return entry
+
+
+def _get_subcommands_import(subcommands, import_dots, lazy_imports):
+    """Return the statements importing the subcommands of a module, on access if lazy."""
+    if lazy_imports:
+        return (
+            f"from {import_dots} pyaz_utils import _lazy_subcommands\n"
+            f"__getattr__, __dir__ = _lazy_subcommands(__name__, {subcommands!r})\n\n"
+        )
+    return f'from . import {", ".join(subcommands)}\n\n'
+
+
+def _get_command_arguments(command):
+    """
+    Return the (required, optional) Argument records of a command, sorted by name.
+
+    Only the fields needed to render the function are copied out of the knack
+    argument objects, so the records don't keep the command table alive.
+    """
+    required_args = []
+    optional_args = []
+
+    # get the dictionary of arguments for the command
+    arguments = tooling.get_arguments(command)
+
+    # loop through each argument object in the arguments dictionary
+    for arg in arguments.values():
+
+        # get the options_list which is the options for this argument in the format:
+        # ['--resource-group', '-g']
+        # remove any non strings from options_list
+        # when testing, found one option with an object of type
+        # knack.deprecation.Deprecated object
+        options_list = [
+            option
+            for option in arg.type.settings.get("options_list", [])
+            if isinstance(option, str)
+        ]
+
+        # if there are no options then the argument name can't be derived
+        if len(options_list) == 0:
+            continue
+
+        # get the first option from the options list as that is the one we want
+        # the second option is the shorter one
+        # and pythonize the name of the argument
+        name = pythonize_name(options_list[0])
+
+        if name.startswith("_") or name in ["__cmd__", "cmd"]:
+            continue
+
+        # create instance of Argument class
+        output_arg = Argument()
+        output_arg.name = name
+        output_arg.flag = options_list[0]
+
+        # get the argument's help text
+        output_arg.help = arg.type.settings.get("help", None)
+
+        # get the argument's default value
+        output_arg.default = arg.type.settings.get("default", None)
+
+        # get whether the argument is required
+        output_arg.required = arg.type.settings.get("required", False)
+
+        # get the constraints on the argument's value checked before calling az
+        _set_argument_rules(output_arg, arg.type.settings)
+
+        if output_arg.required:
+            required_args.append(output_arg)
+        else:
+            optional_args.append(output_arg)
+
+    # sort args by name
+    required_args = sorted(required_args, key=lambda arg: arg.name)
+    optional_args = sorted(optional_args, key=lambda arg: arg.name)
+
+    return required_args, optional_args
+
+
+def _set_argument_rules(output_arg, settings):
+    """Copy the choices, number of values, type and configured default of an argument."""
+    choices = settings.get("choices", None)
+    if choices:
+        output_arg.choices = [str(choice) for choice in choices]
+
+    # arguments appended to take any number of values, like nargs="*"
+    nargs = settings.get("nargs", None)
+    if settings.get("action", None) == "append":
+        nargs = "*"
+    if isinstance(nargs, (int, str)):
+        output_arg.nargs = nargs
 
-def _get_az_function_def(full_command, command_verb, arguments, command_doc):
+    output_arg.type = Constants.VALIDATION_TYPES.get(settings.get("type", None), None)
+
+    # the az config key az fills the argument in from, e.g. defaults.group
+    output_arg.configured_default = settings.get("configured_default", None)
+
+
+def _get_az_function_def(full_command, command_verb, arguments, command_doc, call_options=None):
     """Given a function name, arguments, and doc,returns a formatted string function def."""
+    # format the options passed on to _call_az as keyword arguments
+    call_options = "".join(
+        [f", {option}={value!r}" for option, value in (call_options or {}).items()]
+    )
+
     if command_doc:
         function_def = f"""
 def {command_verb}({arguments}):
     '''
     {command_doc}
     '''
-    return _call_az("az {full_command}", locals())
+    return _call_az("az {full_command}", locals(){call_options})
 
 """
     else:
         function_def = f"""
 def {command_verb}({arguments}):
-    return _call_az("az {full_command}", locals())
+    return _call_az("az {full_command}", locals(){call_options})
+
+"""
+    return function_def
+
+
+def _get_stub_function_def(command_verb, arguments, command_doc):
+    """Given a function name, arguments, and doc, returns a formatted string stub def."""
+    if command_doc:
+        function_def = f"""
+def {command_verb}({arguments}) -> object:
+    '''
+    {command_doc}
+    '''
+    ...
+
+"""
+    else:
+        function_def = f"""
+def {command_verb}({arguments}) -> object: ...
 
 """
     return function_def
 
 
-class Argument:
+class Module:
+    """Represents the generated code of a command group."""
+
+    __slots__ = ("code", "stub", "docs", "dispatch")
+
+    def __init__(self):
+        """Initialize an empty module."""
+        self.code = ""  # the source of the runtime module
+        self.stub = ""  # the source of the .pyi stub
+        self.docs = {}  # the docs keyed by dotted name, for the help index
+        self.dispatch = []  # the entries of the module's commands in the dispatch index
+
+
+class Argument:  # pylint: disable=too-many-instance-attributes
     """Represents an argument to a command."""
 
-    name = ""
-    help = None
-    required = False
-    default = None
+    __slots__ = (
+        "name", "help", "required", "default", "flag", "choices", "nargs", "type",
+        "configured_default",
+    )
+
+    def __init__(self):
+        """Initialize an empty argument record."""
+        self.name = ""
+        self.help = None
+        self.required = False
+        self.default = None
+        self.flag = None
+        self.choices = None  # the values the argument accepts, if limited
+        self.nargs = None  # the number of values the argument takes, None for one
+        self.type = None  # the name of the type of the argument's values, if checked
+        self.configured_default = None  # the az config default key filling it in, if any
 
     def formatted_name(self):
         """Return a formatted argument name."""
@@ -302,7 +617,7 @@ class Argument:
         return name
 
 
-def main():
+def main(streaming=False, lean=False, lazy_imports=False):
     """Generate code in current directory output folder."""
     # get path to the current file's directory
     current_dir = os.path.dirname(os.path.realpath(__file__))
@@ -311,7 +626,7 @@ def main():
     output_dir = os.path.join(current_dir, Constants.OUTPUT_DIR_NAME)
 
     # call function to generate the code in the test dir
-    generate_code(output_dir)
+    generate_code(output_dir, streaming=streaming, lean=lean, lazy_imports=lazy_imports)
 
     # copy the utilities module into the output directory
     source_file = os.path.join(current_dir, Constants.UTILS_FILE_NAME)
@@ -321,5 +636,26 @@ def main():
     shutil.copy(source_file, target_file)
 
 
+def _parse_args():
+    """Parse the command line options of the generator."""
+    parser = argparse.ArgumentParser(description="Generate code for pyaz.")
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help="generate one command group at a time, releasing it once written",
+    )
+    parser.add_argument(
+        "--lean",
+        action="store_true",
+        help="generate modules without docstrings, with the docs in .pyi stubs and a help index",
+    )
+    parser.add_argument(
+        "--lazy-imports",
+        action="store_true",
+        help="generate modules importing their subcommands on first access",
+    )
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
-    main()
+    main(**vars(_parse_args()))
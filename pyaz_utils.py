@@ -1,25 +1,75 @@
-"""Utility functions for the pyaz generated code to use."""
+"""Utility functions for the pyaz generated code to use."""  # pylint: disable=too-many-lines
 
+import builtins
+import collections.abc
+import contextlib
+import contextvars
+import functools
+import importlib
 import json
 import logging
+import os
+import re
 import shlex
 import shutil
+import signal
 import subprocess
-from typing import Dict
+import sys
+import threading
+import time
+import types
+import urllib.parse
+from typing import Dict, List
 
 
-def _call_az(command: str, parameters: Dict) -> object:
+def _call_az(  # pylint: disable=too-many-return-statements
+    command: str,
+    parameters: Dict,
+    ids_batchable: bool = False,
+    paginate: bool = False,
+    validation: Dict = None,
+) -> object:
     """
     Call an az command (supplied as a string, and parameters as dictionary).
 
     Calls az cli via a subprocess
     Returns the az cli json converted to python object
 
+    Commands flagged as ids_batchable that are only given ids are merged with
+    concurrent calls of the same command when ids batching is enabled.
+
+    Commands flagged to paginate return a generator of the results, fetched
+    page by page with the marker az returns.
+
+    The parameters are checked against the command's validation rules first,
+    raising ValueError without calling az, unless disabled.
+
     Example:
     `
     _call_az("az group create", locals())
     `
     """
+    if _validation_enabled and validation:
+        _validate(command, parameters, validation)
+
+    if paginate:
+        return _iter_pages(command, parameters)
+
+    if ids_batchable and _ids_batcher and _has_only_ids(parameters):
+        return _ids_batcher.call(command, parameters["ids"])
+
+    # serve allowlisted reads straight from ARM when the fast path is enabled
+    if _fast_path is not None:
+        try:
+            output = _fast_path.call(command, parameters)
+        except _FastPathFallback as fallback:
+            logging.info("Fast path not taken for %s: %s", command, fallback)
+        else:
+            # return the output of list commands compactly when enabled
+            if _use_compact_results(command) and isinstance(output, list):
+                return _get_compact_records(output)
+            return output
+
     # format the parameters into a list
     params = _get_params(parameters)
 
@@ -36,20 +86,19 @@ def _call_az(command: str, parameters: Dict) -> object:
     # split full command using shlex rules
     commands = shlex.split(full_command)
 
-    # strip off az and replace it with full path to az to accomodate Windows
-    commands.pop(0)
-    commands.insert(0, shutil.which("az"))
-
-    output = subprocess.run(
-        commands,
-        shell=False,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        check=True,
-    )
+    # run the command through the current transport (a subprocess unless replaying)
+    # under the deadline of the call, if any
+    output = _transport.run(commands, _get_call_deadline())
+    output.check_returncode()
     stdout = output.stdout.decode("utf-8")
     stderr = output.stderr.decode("utf-8")
     if stdout:
+        # return the output of list commands compactly when enabled
+        if _use_compact_results(command):
+            try:
+                return CompactList.from_json(stdout, _compact_eager_fields)
+            except ValueError:
+                pass
         try:
             return json.loads(stdout)
         except: # pylint: disable=bare-except
@@ -58,6 +107,129 @@ def _call_az(command: str, parameters: Dict) -> object:
         raise Exception(stderr)
 
 
+def get_doc(target: object) -> str:
+    """
+    Return the help of a generated function or module.
+
+    Modules generated lean have no docstrings, their help is read from the
+    help index next to this module, which is loaded on first use.
+    """
+    if target.__doc__:
+        return target.__doc__
+
+    name = target.__name__
+    if not isinstance(target, types.ModuleType):
+        name = f"{target.__module__}.{name}"
+
+    return _load_help_index().get(_to_index_name(name))
+
+
+def show_help(target: object) -> None:
+    """Show the help of a generated function or module, like the built-in help."""
+    target.__doc__ = get_doc(target)
+    builtins.help(target)
+
+
+def call(command: str, **kwargs) -> object:
+    """
+    Call an az command by its name, e.g. call("storage account show", name="test").
+
+    The command is looked up in the dispatch index and called without importing
+    its module, after checking the keyword arguments against its signature.
+    """
+    entry = _get_dispatch_entry(command)
+    names = [name for name, _, _ in entry["arguments"]]
+
+    unknown = sorted(set(kwargs) - set(names))
+    if unknown:
+        raise TypeError(
+            f"{entry['command']} got unexpected arguments: {', '.join(unknown)}"
+        )
+    missing = [
+        name for name, _, required in entry["arguments"] if required and name not in kwargs
+    ]
+    if missing:
+        raise TypeError(
+            f"{entry['command']} is missing required arguments: {', '.join(missing)}"
+        )
+
+    # pass the arguments in the order of the signature like the generated function
+    parameters = {name: kwargs.get(name) for name in names}
+    return _call_az(f"az {entry['command']}", parameters, **entry["options"])
+
+
+def get_function(command: str) -> object:
+    """Return the generated function of an az command, importing only its module."""
+    entry = _get_dispatch_entry(command)
+    module = importlib.import_module(_from_index_name(entry["module"]))
+    return getattr(module, entry["function"])
+
+
+def _get_dispatch_entry(command: str) -> Dict:
+    """Return the dispatch index entry of a command given with or without the leading az."""
+    command = " ".join(command.split())
+    if command.startswith("az "):
+        command = command[3:]
+
+    entry = _load_dispatch_index().get(command)
+    if entry is None:
+        raise ValueError(f"Unknown command: {command}")
+    return entry
+
+
+def _lazy_subcommands(module_name: str, subcommands: List[str]):
+    """Return the __getattr__ and __dir__ of a module that imports its subcommands on access."""
+
+    def __getattr__(name):  # pylint: disable=invalid-name
+        if name in subcommands:
+            return importlib.import_module(f"{module_name}.{name}")
+        raise AttributeError(f"module {module_name!r} has no attribute {name!r}")
+
+    def __dir__():  # pylint: disable=invalid-name
+        return sorted(set(vars(importlib.import_module(module_name))) | set(subcommands))
+
+    return __getattr__, __dir__
+
+
+@functools.lru_cache(maxsize=None)
+def _load_help_index() -> Dict:
+    """Return the help index of lean modules as a dictionary of docs by dotted name."""
+    return {entry["name"]: entry["doc"] for entry in _read_index("_help_index.jsonl")}
+
+
+@functools.lru_cache(maxsize=None)
+def _load_dispatch_index() -> Dict:
+    """Return the dispatch index as a dictionary of entries by command name."""
+    return {entry["command"]: entry for entry in _read_index("_dispatch_index.jsonl")}
+
+
+def _read_index(file_name: str) -> List[Dict]:
+    """Return the entries of an index file next to this module, if it exists."""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), file_name)
+    if not os.path.exists(path):
+        return []
+    with open(path, mode="r", encoding="utf-8") as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def _to_index_name(name: str) -> str:
+    """
+    Return the dotted name of a generated module as recorded in the indexes.
+
+    The indexes name modules from the pyaz root, e.g. output.pyaz.group -> pyaz.group
+    """
+    package = __name__.rpartition(".")[0]
+    if package and (name == package or name.startswith(package + ".")):
+        name = "pyaz" + name[len(package):]
+    return name
+
+
+def _from_index_name(name: str) -> str:
+    """Return the importable dotted name of a module recorded in the indexes."""
+    package = __name__.rpartition(".")[0] or "pyaz"
+    return package + name[len("pyaz"):]
+
+
 def _get_cli_param_name(name: str) -> str:
     """
     Convert parameter name back to cli format from pythonic version.
@@ -97,14 +269,1325 @@ def _get_params(params: Dict) -> list:
             else:
                 output.append(_get_cli_param_name(param))
 
-                # special case to handle tags, need to apply shlex.split
-                # to handle case where there are multiple tags
-                if param == "tags":
+                # special case to handle tags and ids, need to apply shlex.split
+                # to handle case where there are multiple tags or ids
+                if param in ("tags", "ids") and isinstance(params[param], str):
                     param_values = shlex.split(params[param])
                     param_values = [f'"{value}"' for value in param_values]
                     output.extend(param_values)
+                elif isinstance(params[param], (list, tuple)):
+                    # pass each item of a list as a separate value
+                    output.extend([f'"{value}"' for value in params[param]])
                 else:
                     # wrap parameter value in quotes
                     output.append(f'"{params[param]}"')
 
     return output
+
+
+class SubprocessTransport:
+    """
+    Transport that runs az commands in a subprocess.
+
+    az runs in its own process group, so that when its deadline passes or it is
+    cancelled the whole group, including the processes az spawned, is killed.
+    """
+
+    def __init__(self, executable: str = None):
+        """Run the commands with executable, by default the az found on the path."""
+        self.executable = executable
+
+    def run(self, argv: List[str], deadline=None) -> subprocess.CompletedProcess:
+        """Run the az command given as an argument list starting with az."""
+        # strip off az and replace it with full path to az to accomodate Windows
+        commands = [self.executable or shutil.which("az")] + list(argv[1:])
+
+        # start az in a new process group
+        if os.name == "nt":
+            group_options = {
+                "creationflags": getattr(subprocess, "CREATE_NEW_PROCESS_GROUP", 0)
+            }
+        else:
+            group_options = {"start_new_session": True}
+
+        with subprocess.Popen(
+            commands,
+            shell=False,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            **group_options,
+        ) as process:
+            while True:
+                try:
+                    stdout, stderr = process.communicate(
+                        timeout=None if deadline is None else _POLL_INTERVAL
+                    )
+                    break
+                except subprocess.TimeoutExpired:
+                    if deadline.expired:
+                        _kill_process_group(process)
+                        _, stderr = process.communicate()
+                        raise deadline.get_error(argv, stderr) from None
+
+        return subprocess.CompletedProcess(
+            commands, process.returncode, stdout=stdout, stderr=stderr
+        )
+
+
+class RecordingTransport:
+    """
+    Transport that records the az commands run through another transport.
+
+    Each call is appended to the cassette file as a json line holding the
+    argv, stdout, stderr, exit code and duration of the call.
+
+    Unless redact is False, the values of secret arguments like --admin-password
+    and secret fields of the json output like accessToken are recorded as
+    <redacted>, so that cassettes can be committed.
+    """
+
+    def __init__(self, cassette: str, transport=None, redact: bool = True):
+        """Record into the cassette file the calls run through transport."""
+        self.cassette = cassette
+        self.transport = transport or SubprocessTransport()
+        self.redact = redact
+        self._lock = threading.Lock()
+
+    def run(self, argv: List[str], deadline=None) -> subprocess.CompletedProcess:
+        """Run the az command and record its response."""
+        start = time.perf_counter()
+        output = self.transport.run(argv, deadline)
+        duration = time.perf_counter() - start
+
+        interaction = {
+            "argv": list(argv),
+            "stdout": output.stdout.decode("utf-8"),
+            "stderr": output.stderr.decode("utf-8"),
+            "returncode": output.returncode,
+            "duration": duration,
+        }
+        if self.redact:
+            interaction["argv"] = _redact_argv(interaction["argv"])
+            interaction["stdout"] = _redact_output(interaction["stdout"])
+
+        with self._lock:
+            with open(self.cassette, mode="a", encoding="utf-8") as file:
+                file.write(json.dumps(interaction) + "\n")
+
+        return output
+
+
+class ReplayTransport:
+    """
+    Transport that serves az commands from recorded cassette files.
+
+    Responses are indexed in memory by argv, calls with the same argv are served
+    the recorded responses in order, repeating the last one once exhausted.
+    Secret arguments are redacted before matching, as they are when recording.
+    """
+
+    def __init__(self, *cassettes: str, latency: bool = False):
+        """Load the cassette files, optionally reproducing the recorded latency."""
+        self.latency = latency
+        self._responses = {}
+        self._served = {}
+        self._lock = threading.Lock()
+
+        for cassette in cassettes:
+            with open(cassette, mode="r", encoding="utf-8") as file:
+                for line in file:
+                    if line.strip():
+                        interaction = json.loads(line)
+                        key = tuple(_redact_argv(interaction["argv"]))
+                        self._responses.setdefault(key, []).append(interaction)
+
+    def run(self, argv: List[str], deadline=None) -> subprocess.CompletedProcess:
+        """Return the recorded response for the az command."""
+        key = tuple(_redact_argv(argv))
+        responses = self._responses.get(key)
+        if not responses:
+            raise LookupError(f"No recorded response for command: {' '.join(argv)}")
+
+        with self._lock:
+            index = self._served.get(key, 0)
+            self._served[key] = index + 1
+        interaction = responses[min(index, len(responses) - 1)]
+
+        if self.latency:
+            _wait(threading.Event(), interaction["duration"], deadline)
+        if deadline is not None and deadline.expired:
+            raise deadline.get_error(argv, b"")
+
+        return subprocess.CompletedProcess(
+            list(argv),
+            interaction["returncode"],
+            stdout=interaction["stdout"].encode("utf-8"),
+            stderr=interaction["stderr"].encode("utf-8"),
+        )
+
+
+# the names of arguments and json fields holding secrets, e.g. --admin-password or accessToken
+_SECRET_NAME = re.compile(r"(password|secret|token|connection[-_]?string|key)s?$", re.IGNORECASE)
+_REDACTED = "<redacted>"
+
+
+def _redact_argv(argv: List[str]) -> List[str]:
+    """Return the argv with the values of secret arguments redacted."""
+    redacted = list(argv)
+    for index, arg in enumerate(redacted[:-1]):
+        value = redacted[index + 1]
+        if arg.startswith("--") and _SECRET_NAME.search(arg) and not value.startswith("-"):
+            redacted[index + 1] = _REDACTED
+    return redacted
+
+
+def _redact_output(stdout: str) -> str:
+    """Return the json output with the values of secret fields redacted, else unchanged."""
+    try:
+        output = json.loads(stdout)
+    except ValueError:
+        return stdout
+
+    redacted = _redact_json(output)
+    if redacted == output:
+        return stdout
+    return json.dumps(redacted, indent=2)
+
+
+def _redact_json(value: object) -> object:
+    """Return a copy of the json value with the string values of secret fields redacted."""
+    if isinstance(value, dict):
+        return {
+            key: _REDACTED
+            if isinstance(item, str) and _SECRET_NAME.search(key)
+            else _redact_json(item)
+            for key, item in value.items()
+        }
+    if isinstance(value, list):
+        return [_redact_json(item) for item in value]
+    return value
+
+
+def set_transport(transport) -> object:
+    """
+    Set the transport used to run az commands and return the previous one.
+
+    A transport is any object with a run(argv, deadline) method returning a
+    subprocess.CompletedProcess with stdout and stderr as bytes, deadline is
+    the Deadline of the call or None.
+    """
+    global _transport  # pylint: disable=global-statement,invalid-name
+    previous = _transport
+    _transport = transport
+    return previous
+
+
+def _get_transport_from_env():
+    """
+    Return the transport configured by the environment.
+
+    PYAZ_TRANSPORT is one of subprocess (the default), record or replay,
+    PYAZ_CASSETTE is the cassette file (replay accepts several separated by os.pathsep)
+    and PYAZ_REPLAY_LATENCY=1 reproduces the recorded latency when replaying.
+
+    Raises ValueError for any other mode, or when recording or replaying without a
+    cassette, rather than running the real az commands.
+    """
+    mode = os.environ.get("PYAZ_TRANSPORT", "subprocess")
+    cassette = os.environ.get("PYAZ_CASSETTE", "")
+
+    if mode not in ("subprocess", "record", "replay"):
+        raise ValueError(
+            f"Unknown PYAZ_TRANSPORT {mode!r}, expected one of: subprocess, record, replay"
+        )
+    if mode != "subprocess" and not cassette:
+        raise ValueError(f"PYAZ_TRANSPORT={mode} requires the cassette file in PYAZ_CASSETTE")
+
+    if mode == "record":
+        return RecordingTransport(cassette)
+    if mode == "replay":
+        latency = os.environ.get("PYAZ_REPLAY_LATENCY", "") == "1"
+        return ReplayTransport(*cassette.split(os.pathsep), latency=latency)
+    return SubprocessTransport()
+
+
+_transport = _get_transport_from_env()  # pylint: disable=invalid-name
+
+
+class _IdsBatch:  # pylint: disable=too-many-instance-attributes
+    """
+    A batch of concurrent calls to the same command with only ids.
+
+    The callers joining and leaving the batch are tracked under the batcher's lock.
+    """
+
+    def __init__(self, lock: threading.Lock):
+        self.requests = []  # the list of ids of each caller
+        self.deadlines = []  # the deadline of each caller
+        self.size = 0  # the total number of ids in the batch
+        self.full = threading.Event()  # set when the batch reaches the maximum size
+        self.done = threading.Event()  # set once the batch has run
+        self.result = None
+        self.error = None
+        self.combined = None  # the deadline of the combined call, once started
+        self.active = []  # the index of each caller still waiting when the batch started
+        self.left = set()  # the index of each caller that gave up waiting
+        self.waiting = 0  # the number of callers still waiting for the batch
+        self._lock = lock
+
+    def join(self, ids: List[str], deadline: "Deadline") -> int:
+        """Add a caller's ids to the batch, returning its index; called under the lock."""
+        self.requests.append(ids)
+        self.deadlines.append(deadline)
+        self.size += len(ids)
+        self.waiting += 1
+        return len(self.requests) - 1
+
+    def start(self, command: str) -> None:
+        """Run the batch in a worker thread, so each caller waits under its own deadline."""
+        with self._lock:
+            # the callers that gave up during the batch window are left out
+            self.active = [
+                index for index in range(len(self.requests)) if index not in self.left
+            ]
+            deadlines = [self.deadlines[index] for index in self.active]
+
+            # the combined call runs until the latest deadline of the callers
+            # and is cancelled once every caller has given up waiting for it
+            self.combined = Deadline()
+            if all(deadline and deadline.expires for deadline in deadlines):
+                self.combined.expires = max(deadline.expires for deadline in deadlines)
+
+        threading.Thread(target=self.run, args=(command,), daemon=True).start()
+
+    def leave(self, index: int) -> None:
+        """Stop waiting for the batch, cancelling it once no caller is waiting."""
+        with self._lock:
+            self.left.add(index)
+            self.waiting -= 1
+            if self.waiting == 0 and self.combined is not None:
+                self.combined.cancel()
+
+    def run(self, command: str):
+        """Run the batch as a single az call with the ids of the callers still waiting."""
+        ids = [id_ for index in self.active for id_ in self.requests[index]]
+
+        token = _deadline.set(self.combined)
+        try:
+            self.result = _call_az(command, {"ids": ids})
+        except Exception as error:  # pylint: disable=broad-except
+            self.error = error
+        finally:
+            _deadline.reset(token)
+            self.done.set()
+
+    def get_result(self, command: str, index: int) -> object:
+        """Return the result of the caller at index, falling back to its own call but for delete."""
+        ids = self.requests[index]
+
+        # a batch of one behaves exactly like the unbatched call
+        if len(self.active) == 1:
+            if self.error:
+                raise self.error
+            return self.result
+
+        # a delete isn't repeated by each caller, the batch may have deleted some of
+        # the resources before failing, so every caller shares the batch's outcome
+        if command.split()[-1] == "delete":
+            if self.error is not None:
+                raise self.error
+            return self.result
+
+        # commands with no output have nothing to split
+        if self.error is None and not self.result:
+            return self.result
+
+        # match the resources of the combined output to the caller's ids
+        if self.error is None and isinstance(self.result, list):
+            resources = {
+                resource["id"].lower(): resource
+                for resource in self.result
+                if isinstance(resource, dict) and isinstance(resource.get("id"), str)
+            }
+            matches = [resources.get(id_.lower()) for id_ in ids]
+            if None not in matches:
+                return matches[0] if len(matches) == 1 else matches
+
+        # the batch failed or its output can't be split, so call on our own
+        return _call_az(command, {"ids": ids})
+
+
+class _IdsBatcher:
+    """
+    Merges concurrent calls to the same command with only ids into one az call.
+
+    The first call to a command waits for the batch window, or until the batch
+    reaches the maximum size, and then runs the az command with all the ids of
+    the batch. The output is split back to each caller by resource id.
+    """
+
+    def __init__(self, window: float, max_batch_size: int):
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self._pending = {}  # the batches waiting to run keyed by command
+        self._lock = threading.Lock()
+
+    def call(self, command: str, ids: object) -> object:
+        """Add the ids to the pending batch for the command and return the result."""
+        if isinstance(ids, str):
+            ids = shlex.split(ids)
+        ids = list(ids)
+
+        with self._lock:
+            batch = self._pending.get(command)
+            leader = batch is None
+            if leader:
+                batch = self._pending[command] = _IdsBatch(self._lock)
+
+            index = batch.join(ids, _get_call_deadline())
+
+            # stop adding to the batch once it is full
+            if batch.size >= self.max_batch_size:
+                del self._pending[command]
+                batch.full.set()
+
+        if leader:
+            batch.full.wait(self.window)
+            with self._lock:
+                if self._pending.get(command) is batch:
+                    del self._pending[command]
+            batch.start(command)
+
+        # every caller, the leader included, gives up waiting at its own deadline
+        deadline = batch.deadlines[index]
+        if not _wait(batch.done, None, deadline):
+            batch.leave(index)
+            raise deadline.get_error(shlex.split(command) + ["--ids"] + ids, b"")
+
+        return batch.get_result(command, index)
+
+
+def _has_only_ids(parameters: Dict) -> bool:
+    """Return whether ids is the only parameter given a value."""
+    return bool(parameters.get("ids")) and not any(
+        value for name, value in parameters.items() if name != "ids"
+    )
+
+
+def enable_ids_batching(window: float = 0.05, max_batch_size: int = 50) -> None:
+    """
+    Batch concurrent calls to the same command with only ids into one az call.
+
+    Calls are merged when they arrive within window seconds of the first call
+    of the batch, up to max_batch_size ids.
+    """
+    global _ids_batcher  # pylint: disable=global-statement,invalid-name
+    _ids_batcher = _IdsBatcher(window, max_batch_size)
+
+
+def disable_ids_batching() -> None:
+    """Run each call with ids in its own az call, the default."""
+    global _ids_batcher  # pylint: disable=global-statement,invalid-name
+    _ids_batcher = None
+
+
+_ids_batcher = None  # pylint: disable=invalid-name
+
+
+class _FastPathFallback(Exception):
+    """Raised when a call can't be served by the ARM fast path and needs az."""
+
+
+class ArmFastPath:
+    """
+    Serves allowlisted read commands with direct ARM REST GETs instead of az.
+
+    Each thread keeps one keep-alive connection to the ARM endpoint. The output
+    is shaped like az's, and anything the fast path can't serve exactly, like
+    other parameters, a subscription given by name or an error response,
+    falls back to az.
+    """
+
+    API_VERSION = "2021-04-01"  # the api version of the resources and providers apis
+
+    def __init__(
+        self,
+        endpoint: str = "https://management.azure.com",
+        token_provider=None,
+        subscription: str = None,
+        commands: List[str] = None,
+    ):
+        """
+        Serve the commands (by default all of FAST_PATH_COMMANDS) from the ARM endpoint.
+
+        token_provider is a function returning the bearer token, by default read from
+        the az credential cache, subscription is the default subscription id, by default
+        read from the az profile.
+        """
+        self.endpoint = urllib.parse.urlsplit(endpoint)
+        self.token_provider = token_provider or _AzTokenCache().get_token
+        self.subscription = subscription
+        self.commands = set(FAST_PATH_COMMANDS if commands is None else commands)
+        if not self.commands <= set(FAST_PATH_COMMANDS):
+            raise ValueError(f"Commands not supported by the fast path: {self.commands}")
+        self._local = threading.local()
+        self._api_versions = {}  # the api versions of resource types
+
+    def call(self, command: str, parameters: Dict) -> object:
+        """Return the output of the command, raising _FastPathFallback if az is needed."""
+        if command not in self.commands:
+            raise _FastPathFallback("command not allowlisted")
+
+        handler, supported, fields = FAST_PATH_COMMANDS[command]
+        unsupported = [
+            name for name, value in parameters.items() if value and name not in supported
+        ]
+        if unsupported:
+            raise _FastPathFallback(f"unsupported parameters {unsupported}")
+
+        output = handler(self, parameters)
+        _add_null_fields(output, fields)
+        _add_resource_group(output)
+        return output
+
+    def get(self, path: str, params: Dict = None) -> object:
+        """Return the json of an ARM GET of path, following the nextLink of lists."""
+        query = {"api-version": self.API_VERSION, **(params or {})}
+        url = f"{path}?{urllib.parse.urlencode(query)}"
+
+        output = self._request(url)
+        if "nextLink" not in output:
+            return output
+
+        # collect the value of all the pages
+        values = output["value"]
+        while output.get("nextLink"):
+            next_link = urllib.parse.urlsplit(output["nextLink"])
+            next_query = dict(urllib.parse.parse_qsl(next_link.query))
+            next_query.setdefault("api-version", query["api-version"])
+            output = self._request(f"{next_link.path}?{urllib.parse.urlencode(next_query)}")
+            values.extend(output["value"])
+        return {"value": values}
+
+    def get_subscription(self, parameters: Dict) -> str:
+        """Return the subscription id of the call."""
+        subscription = parameters.get("subscription") or self.subscription
+        if not subscription:
+            subscription = self.subscription = _get_default_account()["id"]
+        if not re.fullmatch(r"[0-9a-fA-F-]{36}", subscription or ""):
+            raise _FastPathFallback("subscription is not an id")
+        return subscription
+
+    def get_api_version(self, resource_id: str) -> str:
+        """Return the api version of the resource type of resource_id, like az resolves it."""
+        # e.g. /subscriptions/{s}/resourceGroups/{g}/providers/Microsoft.Compute/virtualMachines/{n}
+        parts = resource_id.strip("/").split("/")
+        lowered = [part.lower() for part in parts]
+        if "providers" not in lowered or len(parts) < 2:
+            raise _FastPathFallback("not a provider resource id")
+        index = len(lowered) - 1 - lowered[::-1].index("providers")
+        namespace = parts[index + 1]
+        resource_type = "/".join(parts[index + 2::2])
+        key = f"{namespace}/{resource_type}".lower()
+
+        if key not in self._api_versions:
+            provider = self.get(f"/subscriptions/{parts[1]}/providers/{namespace}")
+            for provider_type in provider.get("resourceTypes", []):
+                versions = sorted(provider_type.get("apiVersions", []), reverse=True)
+                stable = [version for version in versions if "preview" not in version]
+                if versions:
+                    type_key = f"{namespace}/{provider_type['resourceType']}".lower()
+                    self._api_versions[type_key] = (stable or versions)[0]
+
+        if key not in self._api_versions:
+            raise _FastPathFallback(f"no api version for {key}")
+        return self._api_versions[key]
+
+    def _request(self, url: str) -> object:
+        """
+        Return the json of an ARM GET, reusing the thread's connection.
+
+        Raises AzTimeoutError when the deadline of the call passes, and
+        _FastPathFallback for any other failure so that az is called instead.
+        """
+        import http.client  # pylint: disable=import-outside-toplevel
+        import socket  # pylint: disable=import-outside-toplevel
+
+        deadline = _get_call_deadline()
+        headers = {
+            "Authorization": f"Bearer {self.token_provider()}",
+            "Accept": "application/json",
+            "User-Agent": "pyaz",
+        }
+        logging.info("Fast path: GET %s", url)
+
+        # retry once on a new connection if the kept alive one was closed
+        for attempt in range(2):
+            # bound the request by the deadline of the call, a timeout of 0 would
+            # make the socket non-blocking so no time left counts as expired
+            timeout = None if deadline is None else deadline.remaining()
+            if deadline is not None and (deadline.expired or timeout == 0):
+                raise deadline.get_error(["GET", url], b"")
+
+            connection = self._get_connection()
+            connection.timeout = timeout
+            if connection.sock is not None:
+                connection.sock.settimeout(timeout)
+            try:
+                connection.request("GET", url, headers=headers)
+                response = connection.getresponse()
+                body = response.read()
+                break
+            except socket.timeout as error:
+                # socket.timeout is only an alias of TimeoutError from python 3.10
+                connection.close()
+                self._local.connection = None
+                if deadline is not None:
+                    raise deadline.get_error(["GET", url], b"") from error
+                raise _FastPathFallback(f"request timed out: {error}") from error
+            except (http.client.HTTPException, OSError) as error:
+                # connection, name resolution and ssl errors are all OSErrors
+                connection.close()
+                self._local.connection = None
+                if attempt == 1:
+                    raise _FastPathFallback(f"request failed: {error}") from error
+
+        if response.status != 200:
+            raise _FastPathFallback(f"status {response.status}")
+        try:
+            return json.loads(body)
+        except ValueError as error:
+            raise _FastPathFallback(f"invalid json response: {error}") from error
+
+    def _get_connection(self) -> "http.client.HTTPConnection":
+        """Return the keep-alive connection of the current thread."""
+        # imported here to keep it out of the import cost of pyaz
+        import http.client  # pylint: disable=import-outside-toplevel
+
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            if self.endpoint.scheme == "http":
+                connection = http.client.HTTPConnection(self.endpoint.netloc)
+            else:
+                connection = http.client.HTTPSConnection(self.endpoint.netloc)
+            self._local.connection = connection
+        return connection
+
+
+def _group_show(fast_path: ArmFastPath, parameters: Dict) -> object:
+    """Return the output of az group show."""
+    if not parameters.get("name"):
+        raise _FastPathFallback("group show needs name")
+    subscription = fast_path.get_subscription(parameters)
+    name = urllib.parse.quote(parameters["name"])
+    return fast_path.get(f"/subscriptions/{subscription}/resourcegroups/{name}")
+
+
+def _group_list(fast_path: ArmFastPath, parameters: Dict) -> object:
+    """Return the output of az group list."""
+    subscription = fast_path.get_subscription(parameters)
+    return fast_path.get(f"/subscriptions/{subscription}/resourcegroups")["value"]
+
+
+def _resource_show(fast_path: ArmFastPath, parameters: Dict) -> object:
+    """Return the output of az resource show with ids."""
+    ids = parameters.get("ids")
+    if not ids:
+        raise _FastPathFallback("resource show needs ids")
+    if isinstance(ids, str):
+        ids = shlex.split(ids)
+
+    resources = []
+    for id_ in ids:
+        api_version = fast_path.get_api_version(id_)
+        resources.append(fast_path.get(urllib.parse.quote(id_), {"api-version": api_version}))
+    return resources[0] if len(resources) == 1 else resources
+
+
+def _resource_list(fast_path: ArmFastPath, parameters: Dict) -> object:
+    """Return the output of az resource list."""
+    path = f"/subscriptions/{fast_path.get_subscription(parameters)}"
+    if parameters.get("resource_group"):
+        path += f"/resourceGroups/{urllib.parse.quote(parameters['resource_group'])}"
+
+    # az expands the same properties of the resources
+    expand = {"$expand": "createdTime,changedTime,provisioningState"}
+    return fast_path.get(f"{path}/resources", expand)["value"]
+
+
+# the fields az outputs for resource groups and resources, null when ARM leaves them out
+GROUP_FIELDS = ("id", "location", "managedBy", "name", "properties", "tags", "type")
+RESOURCE_FIELDS = (
+    "extendedLocation", "id", "identity", "kind", "location", "managedBy", "name", "plan",
+    "properties", "sku", "tags", "type",
+)
+EXPANDED_RESOURCE_FIELDS = RESOURCE_FIELDS + ("changedTime", "createdTime", "provisioningState")
+
+# the commands served by the fast path, with their handler, supported parameters and fields
+FAST_PATH_COMMANDS = {
+    "az group show": (_group_show, {"name", "subscription"}, GROUP_FIELDS),
+    "az group list": (_group_list, {"subscription"}, GROUP_FIELDS),
+    "az resource show": (_resource_show, {"ids"}, RESOURCE_FIELDS),
+    "az resource list": (
+        _resource_list, {"resource_group", "subscription"}, EXPANDED_RESOURCE_FIELDS
+    ),
+}
+
+
+def _add_null_fields(obj: object, fields: tuple) -> None:
+    """Add the fields missing from the output as null, like az does."""
+    for item in obj if isinstance(obj, list) else [obj]:
+        if isinstance(item, dict):
+            for field in fields:
+                item.setdefault(field, None)
+
+
+def _add_resource_group(obj: object) -> None:
+    """Add the resourceGroup parsed from the id to the output, like az does."""
+    if isinstance(obj, list):
+        for item in obj:
+            _add_resource_group(item)
+    elif isinstance(obj, dict):
+        try:
+            if "resourcegroup" not in [key.lower() for key in obj]:
+                if obj["id"]:
+                    parts = obj["id"].split("/")
+                    if parts[3].lower() == "resourcegroups" and parts[8]:
+                        obj["resourceGroup"] = parts[4]
+        except (KeyError, IndexError, TypeError, AttributeError):
+            pass
+        for key in obj:
+            if key != "sourceVault":
+                _add_resource_group(obj[key])
+
+
+class _AzTokenCache:
+    """
+    Bearer tokens for ARM from the az credential cache.
+
+    Valid tokens of the default subscription's tenant are read from the msal
+    token cache az keeps in its config dir, if it is not encrypted,
+    falling back to az account get-access-token.
+    """
+
+    RESOURCE = "https://management.core.windows.net/"
+
+    def __init__(self):
+        self._token = None
+        self._expires = 0
+        self._lock = threading.Lock()
+
+    def get_token(self) -> str:
+        """Return a token valid for at least five more minutes."""
+        with self._lock:
+            if time.time() + 300 > self._expires:
+                self._token, self._expires = self._read_msal_cache() or self._get_az_token()
+            return self._token
+
+    def _read_msal_cache(self):
+        """Return the token and its expiry from the msal token cache, if there is one."""
+        try:
+            tenant = _get_default_account().get("tenantId")
+        except _FastPathFallback:
+            tenant = None
+
+        path = os.path.join(_get_az_config_dir(), "msal_token_cache.json")
+        try:
+            with open(path, mode="r", encoding="utf-8") as file:
+                tokens = json.load(file).get("AccessToken", {}).values()
+        except (OSError, ValueError):
+            return None
+
+        for token in tokens:
+            expires = int(token.get("expires_on", 0))
+            if (
+                self.RESOURCE in token.get("target", "")
+                and tenant in (None, token.get("realm"))
+                and time.time() + 300 < expires
+            ):
+                return token["secret"], expires
+        return None
+
+    def _get_az_token(self):
+        """Return a token and its expiry from az account get-access-token."""
+        output = _call_az("az account get-access-token", {"resource": self.RESOURCE})
+        return output["accessToken"], int(output.get("expires_on", time.time() + 600))
+
+
+def _get_az_config_dir() -> str:
+    """Return the config dir of az."""
+    return os.environ.get("AZURE_CONFIG_DIR") or os.path.expanduser(os.path.join("~", ".azure"))
+
+
+def _get_default_account() -> Dict:
+    """Return the default subscription in the az profile."""
+    path = os.path.join(_get_az_config_dir(), "azureProfile.json")
+    try:
+        with open(path, mode="r", encoding="utf-8-sig") as file:
+            subscriptions = json.load(file).get("subscriptions", [])
+    except (OSError, ValueError) as error:
+        raise _FastPathFallback("no az profile") from error
+
+    for subscription in subscriptions:
+        if subscription.get("isDefault"):
+            return subscription
+    raise _FastPathFallback("no default subscription")
+
+
+def enable_fast_path(**options) -> None:
+    """
+    Serve the allowlisted read commands with direct ARM REST calls.
+
+    The options are passed on to ArmFastPath, other commands run az as usual.
+    """
+    global _fast_path  # pylint: disable=global-statement,invalid-name
+    _fast_path = ArmFastPath(**options)
+
+
+def disable_fast_path() -> None:
+    """Run all the commands with az, the default."""
+    global _fast_path  # pylint: disable=global-statement,invalid-name
+    _fast_path = None
+
+
+_fast_path = None  # pylint: disable=invalid-name
+
+
+def _validate(command: str, parameters: Dict, entry: Dict) -> None:
+    """
+    Check the parameters of an az command against its validation rules.
+
+    Raises ValueError for a missing required argument, a value not in the
+    argument's choices, the wrong number of values or a value of the wrong type.
+    """
+    if entry.get("extension") in _validation_skipped_extensions:
+        return
+
+    missing = [name for name in entry["required"] if parameters.get(name) is None]
+    if missing:
+        raise ValueError(f"{command} is missing required arguments: {', '.join(missing)}")
+
+    for name, rule in entry["arguments"].items():
+        value = parameters.get(name)
+
+        # values that aren't passed to az, and flags, aren't checked
+        if not value or isinstance(value, bool):
+            continue
+
+        values = list(value) if isinstance(value, (list, tuple)) else [value]
+        nargs = rule.get("nargs")
+        if nargs in (None, "?") and len(values) > 1:
+            raise ValueError(f"{command} argument {name} takes a single value, got {value!r}")
+        if isinstance(nargs, int) and len(values) != nargs:
+            raise ValueError(f"{command} argument {name} takes {nargs} values, got {value!r}")
+
+        for item in values:
+            _validate_value(command, name, rule, item)
+
+
+def _validate_value(command: str, name: str, rule: Dict, value: object) -> None:
+    """Check a single value of an argument against its type and choices."""
+    value_type = {"int": int, "float": float}.get(rule.get("type"))
+    if value_type is not None:
+        try:
+            value_type(value)
+        except (TypeError, ValueError):
+            raise ValueError(
+                f"{command} argument {name} expects an {rule['type']} value, got {value!r}"
+            ) from None
+
+    # az matches choices regardless of case
+    choices = rule.get("choices")
+    if choices and str(value).lower() not in [choice.lower() for choice in choices]:
+        raise ValueError(
+            f"{command} argument {name} got invalid choice {value!r},"
+            f" expected one of: {', '.join(choices)}"
+        )
+
+
+def enable_validation() -> None:
+    """Check the parameters of az calls against their validation rules, the default."""
+    global _validation_enabled, _validation_skipped_extensions  # pylint: disable=global-statement,invalid-name
+    _validation_enabled = True
+    _validation_skipped_extensions = frozenset()
+
+
+def disable_validation(extensions: List[str] = None) -> None:
+    """
+    Stop checking the parameters of az calls before calling az.
+
+    When extensions are given only the commands of those extensions, whose
+    argument metadata may be loose, are no longer checked.
+    """
+    global _validation_enabled, _validation_skipped_extensions  # pylint: disable=global-statement,invalid-name
+    if extensions is None:
+        _validation_enabled = False
+    else:
+        _validation_skipped_extensions = _validation_skipped_extensions | frozenset(extensions)
+
+
+_validation_enabled = True  # pylint: disable=invalid-name
+_validation_skipped_extensions = frozenset()  # pylint: disable=invalid-name
+
+
+class _JsonText(str):
+    """Compact json text of a nested value, decoded on access."""
+
+    __slots__ = ()
+
+
+_MISSING = object()  # the value of a column for a record without the key
+
+
+class CompactList(collections.abc.Sequence):
+    """
+    A compact, read-only list of json objects stored as columns.
+
+    Each key is interned and its values are stored in a single column. The eager
+    fields are kept decoded, nested objects and arrays of the other fields are
+    kept as compact json text and decoded on access. Records are read through
+    CompactRecord views, which behave like read-only dicts.
+    """
+
+    __slots__ = ("_columns", "_length")
+
+    def __init__(self, columns: Dict, length: int):
+        """Create the list from the columns of values keyed by field."""
+        self._columns = columns
+        self._length = length
+
+    @classmethod
+    def from_records(cls, records, eager_fields=()) -> "CompactList":
+        """Return the compact list of an iterable of dicts, raising ValueError for other values."""
+        eager_fields = set(eager_fields)
+        columns = {}
+        length = 0
+        for record in records:
+            if not isinstance(record, dict):
+                raise ValueError("Only lists of objects can be made compact")
+            for key, value in record.items():
+                column = columns.get(key)
+                if column is None:
+                    column = columns[sys.intern(key)] = [_MISSING] * length
+                column.append(_compact_value(value, key in eager_fields))
+            length += 1
+
+            # pad the columns of the keys missing from the record
+            for column in columns.values():
+                if len(column) < length:
+                    column.append(_MISSING)
+
+        return cls(columns, length)
+
+    @classmethod
+    def from_json(cls, text: str, eager_fields=()) -> "CompactList":
+        """
+        Return the compact list of a json array of objects, raising ValueError for other json.
+
+        The objects are decoded one at a time, so the whole array is never held as dicts.
+        """
+        return cls.from_records(_iter_json_array(text), eager_fields)
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self._take(range(self._length)[index])
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError("CompactList index out of range")
+        return CompactRecord(self, index)
+
+    def __repr__(self) -> str:
+        return f"CompactList({self.to_list()!r})"
+
+    @property
+    def fields(self) -> List[str]:
+        """Return the fields of the records."""
+        return list(self._columns)
+
+    def column(self, field: str) -> List:
+        """Return the decoded values of a field, None for records without it."""
+        return [
+            None if value is _MISSING else _decode_value(value)
+            for value in self._columns.get(field, [_MISSING] * self._length)
+        ]
+
+    def where(self, field: str, predicate) -> "CompactList":
+        """Return the records whose value of field satisfies predicate, without building dicts."""
+        return self._take(
+            [index for index, value in enumerate(self.column(field)) if predicate(value)]
+        )
+
+    def select(self, *fields: str) -> "CompactList":
+        """Return the records projected to the fields."""
+        return CompactList(
+            {field: self._columns[field] for field in fields if field in self._columns},
+            self._length,
+        )
+
+    def to_list(self) -> List[Dict]:
+        """Return the records as a list of dicts."""
+        return [dict(record) for record in self]
+
+    def _get(self, index: int, field: str) -> object:
+        """Return the decoded value of field for the record at index, KeyError if missing."""
+        column = self._columns.get(field)
+        value = _MISSING if column is None else column[index]
+        if value is _MISSING:
+            raise KeyError(field)
+        return _decode_value(value)
+
+    def _keys(self, index: int) -> List[str]:
+        """Return the fields of the record at index."""
+        return [field for field, column in self._columns.items() if column[index] is not _MISSING]
+
+    def _take(self, indexes) -> "CompactList":
+        """Return the records at indexes."""
+        return CompactList(
+            {
+                field: [column[index] for index in indexes]
+                for field, column in self._columns.items()
+            },
+            len(indexes),
+        )
+
+
+class CompactRecord(collections.abc.Mapping):
+    """A read-only dict view of a record of a CompactList."""
+
+    __slots__ = ("_table", "_index")
+
+    def __init__(self, table: CompactList, index: int):
+        self._table = table
+        self._index = index
+
+    def __getitem__(self, key: str) -> object:
+        return self._table._get(self._index, key)  # pylint: disable=protected-access
+
+    def __iter__(self):
+        return iter(self._table._keys(self._index))  # pylint: disable=protected-access
+
+    def __len__(self) -> int:
+        return len(self._table._keys(self._index))  # pylint: disable=protected-access
+
+    def __repr__(self) -> str:
+        return repr(dict(self))
+
+
+def _compact_value(value: object, eager: bool) -> object:
+    """Return the value as stored in a column."""
+    if isinstance(value, (dict, list)) and not eager:
+        return _JsonText(json.dumps(value, separators=(",", ":")))
+    if isinstance(value, str) and len(value) <= 64:
+        # short strings like locations and types repeat across records
+        return sys.intern(value)
+    return value
+
+
+def _get_compact_records(records: list) -> object:
+    """Return the records as a CompactList, or as they are if they aren't all objects."""
+    try:
+        return CompactList.from_records(records, _compact_eager_fields)
+    except ValueError:
+        return records
+
+
+def _decode_value(value: object) -> object:
+    """Return the value stored in a column decoded."""
+    if isinstance(value, _JsonText):
+        return json.loads(value)
+    return value
+
+
+def _iter_json_array(text: str):
+    """Yield the items of a json array one at a time, raising ValueError if text isn't one."""
+    decoder = json.JSONDecoder()
+    whitespace = re.compile(r"\s*")
+
+    index = whitespace.match(text, 0).end()
+    if text[index:index + 1] != "[":
+        raise ValueError("Not a json array")
+    index = whitespace.match(text, index + 1).end()
+    if text[index:index + 1] == "]":
+        return
+
+    while True:
+        item, index = decoder.raw_decode(text, index)
+        yield item
+        index = whitespace.match(text, index).end()
+        if text[index:index + 1] == "]":
+            return
+        if text[index:index + 1] != ",":
+            raise ValueError("Invalid json array")
+        index = whitespace.match(text, index + 1).end()
+
+
+def _use_compact_results(command: str) -> bool:
+    """Return whether the output of the command is returned compactly."""
+    if _compact_eager_fields is None:
+        return False
+    verb = command.split()[-1]
+    return verb == "list" or verb.startswith("list-")
+
+
+def enable_compact_results(eager_fields=("id", "name")) -> None:
+    """
+    Return the output of list commands as a CompactList instead of a list of dicts.
+
+    The eager fields are kept decoded, nested values of the others are decoded on access.
+    """
+    global _compact_eager_fields  # pylint: disable=global-statement,invalid-name
+    _compact_eager_fields = tuple(eager_fields)
+
+
+def disable_compact_results() -> None:
+    """Return the output of list commands as a list of dicts, the default."""
+    global _compact_eager_fields  # pylint: disable=global-statement,invalid-name
+    _compact_eager_fields = None
+
+
+_compact_eager_fields = None  # pylint: disable=invalid-name
+
+
+class _PagePrefetch:
+    """Fetch a page of results in a background thread, under the caller's deadline."""
+
+    def __init__(self, command: str, parameters: Dict):
+        self.result = None
+        self.error = None
+
+        # run in a copy of the caller's context so the deadline propagates
+        context = contextvars.copy_context()
+        self.thread = threading.Thread(
+            target=context.run, args=(self._run, command, parameters), daemon=True
+        )
+        self.thread.start()
+
+    def _run(self, command: str, parameters: Dict) -> None:
+        """Fetch the page, keeping the items and the next marker or the error."""
+        try:
+            self.result = _get_page(command, parameters)
+        except BaseException as error:  # pylint: disable=broad-except
+            self.error = error
+
+    def get(self) -> tuple:
+        """Wait for the page and return its (items, next marker), raising its error."""
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+def _get_page(command: str, parameters: Dict) -> tuple:
+    """Call az for a page of results and return its (items, next marker)."""
+    output = _call_az(command, parameters)
+    items = list(output or [])
+
+    # with --show-next-marker az appends the marker of the next page to the results
+    marker = None
+    if items and isinstance(items[-1], collections.abc.Mapping):
+        if list(items[-1]) == ["nextMarker"]:
+            marker = items.pop()["nextMarker"]
+    return items, marker
+
+
+def _iter_pages(command: str, parameters: Dict):
+    """
+    Yield the results of a command supporting --marker and --num-results page by page.
+
+    The next page is fetched in the background while the current one is consumed,
+    so only about two pages are held in memory at once.
+    """
+    parameters = dict(parameters)
+    page_size = parameters.pop("page_size", None) or _default_page_size
+    parameters.update(num_results=page_size, show_next_marker=True, marker=None)
+
+    page = _PagePrefetch(command, parameters)
+    while page is not None:
+        items, marker = page.get()
+        page = None
+        if marker:
+            page = _PagePrefetch(command, dict(parameters, marker=marker))
+        yield from items
+
+
+def set_default_page_size(page_size: int) -> None:
+    """Set the number of results fetched per page by the iter_ functions, 1000 by default."""
+    global _default_page_size  # pylint: disable=global-statement,invalid-name
+    _default_page_size = page_size
+
+
+_default_page_size = 1000  # pylint: disable=invalid-name
+
+
+_POLL_INTERVAL = 0.05  # seconds between checks of the deadline while waiting
+
+
+class AzTimeoutError(TimeoutError):
+    """Raised when an az call doesn't finish before its deadline."""
+
+    def __init__(self, command: List[str], stderr: str):
+        super().__init__(f"Command timed out: {' '.join(command)}")
+        self.command = command  # the argv of the az call
+        self.stderr = stderr  # the stderr written by az before it was killed
+
+
+class AzCancelledError(AzTimeoutError):
+    """Raised when an az call is cancelled."""
+
+    def __init__(self, command: List[str], stderr: str):
+        super().__init__(command, stderr)
+        self.args = (f"Command cancelled: {' '.join(command)}",)
+
+
+class Deadline:
+    """
+    A point in time by which az calls must finish, which can also be cancelled.
+
+    A deadline nested in another one expires no later than its parent
+    and is cancelled along with it.
+    """
+
+    def __init__(self, timeout: float = None, parent=None):
+        """Create a deadline timeout seconds from now, or without a time limit if None."""
+        self.parent = parent
+        self.expires = None if timeout is None else time.monotonic() + timeout
+        if parent is not None and parent.expires is not None:
+            if self.expires is None or parent.expires < self.expires:
+                self.expires = parent.expires
+        self._cancelled = threading.Event()
+
+    def cancel(self) -> None:
+        """Cancel the deadline, killing the az calls running under it. Thread safe."""
+        self._cancelled.set()
+
+    @property
+    def cancelled(self) -> bool:
+        """Return whether the deadline or one of its parents was cancelled."""
+        return self._cancelled.is_set() or (
+            self.parent is not None and self.parent.cancelled
+        )
+
+    @property
+    def expired(self) -> bool:
+        """Return whether the deadline passed or was cancelled."""
+        return self.cancelled or (
+            self.expires is not None and time.monotonic() >= self.expires
+        )
+
+    def remaining(self) -> float:
+        """Return the seconds left until the deadline, or None if there is no time limit."""
+        if self.expires is None:
+            return None
+        return max(0.0, self.expires - time.monotonic())
+
+    def get_error(self, command: List[str], stderr: bytes) -> AzTimeoutError:
+        """Return the error for a call of command that didn't finish before the deadline."""
+        error_class = AzCancelledError if self.cancelled else AzTimeoutError
+        return error_class(command, stderr.decode("utf-8", errors="replace"))
+
+
+@contextlib.contextmanager
+def deadline_scope(timeout: float = None):
+    """
+    Run the az calls made inside the block under a deadline, yielding the Deadline.
+
+    The deadline is propagated to the nested and batched calls made from the block
+    and can be cancelled from other threads.
+
+    Example:
+    `
+    with deadline_scope(30) as scope:
+        pyaz.group.show(name="test")
+    `
+    """
+    scope = Deadline(timeout, _deadline.get())
+    token = _deadline.set(scope)
+    try:
+        yield scope
+    finally:
+        _deadline.reset(token)
+
+
+def set_default_timeout(timeout: float) -> None:
+    """Set the timeout in seconds of each az call, None (the default) for no timeout."""
+    global _default_timeout  # pylint: disable=global-statement,invalid-name
+    _default_timeout = timeout
+
+
+async def run_async(function, *args, **kwargs) -> object:
+    """
+    Run a generated function in a thread from an asyncio task.
+
+    When the task is cancelled, for example by asyncio.wait_for, the az call
+    is killed and the task's CancelledError is raised.
+    """
+    # imported here to keep it out of the import cost of pyaz
+    import asyncio  # pylint: disable=import-outside-toplevel
+
+    scope = Deadline(parent=_deadline.get())
+    context = contextvars.copy_context()
+    context.run(_deadline.set, scope)
+
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(
+        None, functools.partial(context.run, function, *args, **kwargs)
+    )
+    try:
+        return await future
+    except asyncio.CancelledError:
+        scope.cancel()
+        raise
+
+
+def _get_call_deadline() -> Deadline:
+    """Return the deadline of an az call from the current context and the default timeout."""
+    parent = _deadline.get()
+    if _default_timeout is None:
+        return parent
+    return Deadline(_default_timeout, parent)
+
+
+def _wait(event: threading.Event, timeout: float, deadline: Deadline) -> bool:
+    """
+    Wait for the event up to timeout seconds, or forever if None.
+
+    Gives up early once the deadline expires, returns whether the event was set.
+    """
+    end = None if timeout is None else time.monotonic() + timeout
+    while True:
+        wait = _POLL_INTERVAL
+        if end is not None:
+            wait = min(wait, end - time.monotonic())
+            if wait <= 0:
+                return event.is_set()
+        if deadline is None and end is None:
+            wait = None
+        if event.wait(wait):
+            return True
+        if deadline is not None and deadline.expired:
+            return False
+
+
+def _kill_process_group(process: subprocess.Popen) -> None:
+    """Kill the process and all the processes in its group."""
+    if os.name == "nt":
+        subprocess.run(
+            ["taskkill", "/F", "/T", "/PID", str(process.pid)],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            check=False,
+        )
+    else:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+    process.kill()
+
+
+_deadline = contextvars.ContextVar("pyaz_deadline", default=None)
+_default_timeout = None  # pylint: disable=invalid-name
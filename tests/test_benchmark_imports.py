@@ -0,0 +1,139 @@
+"""Tests for module benchmark_imports."""
+import os
+import tempfile
+import unittest
+from unittest import mock
+import benchmark_imports
+
+
+# pylint: disable=protected-access
+
+class TestUnit(unittest.TestCase):
+    """Unit tests for benchmark_imports."""
+
+    def setUp(self):
+        self.results = {
+            "pyaz": {
+                "cold_import_seconds": 0.2,
+                "warm_import_seconds": 0.1,
+                "memory_bytes": 1000000,
+            },
+            "pyaz.vm": {
+                "cold_import_seconds": 0.3,
+                "warm_import_seconds": 0.15,
+                "memory_bytes": 2000000,
+            },
+        }
+
+    def test_check_budgets(self):
+        """Test that results over budget fail, with * as the default budget."""
+        budgets = {
+            "pyaz": {"warm_import_seconds": 0.2},
+            "*": {"memory_bytes": 1500000},
+        }
+        failures = benchmark_imports.check_budgets(self.results, budgets)
+        self.assertEqual(1, len(failures))
+        self.assertIn("pyaz.vm memory_bytes", failures[0])
+
+    def test_compare_baseline(self):
+        """Test that results regressing over the baseline tolerance fail."""
+        baseline = {
+            "pyaz": {
+                "cold_import_seconds": 0.2,
+                "warm_import_seconds": 0.05,
+                "memory_bytes": 1000000,
+            },
+        }
+        failures = benchmark_imports.compare_baseline(self.results, baseline, tolerance=0.2)
+        self.assertEqual(1, len(failures))
+        self.assertIn("pyaz warm_import_seconds", failures[0])
+
+    def test_compare_baseline_noise(self):
+        """Test that tiny regressions within the noise allowance don't fail."""
+        baseline = {
+            "pyaz": {
+                "cold_import_seconds": 0.199,
+                "warm_import_seconds": 0.099,
+                "memory_bytes": 999000,
+            },
+        }
+        self.assertEqual(
+            [], benchmark_imports.compare_baseline(self.results, baseline, tolerance=0)
+        )
+
+    def test_parse_importtime(self):
+        """Test that the self and cumulative times are parsed from -X importtime output."""
+        stderr = (
+            b"import time: self [us] | cumulative | imported package\n"
+            b"import time:       120 |        120 |   pyaz.pyaz_utils\n"
+            b"import time:        30 |        150 | pyaz\n"
+        )
+        expected = {"pyaz.pyaz_utils": [0.00012, 0.00012], "pyaz": [0.00003, 0.00015]}
+        self.assertEqual(expected, benchmark_imports._parse_importtime(stderr))
+
+    def test_check_bytecode(self):
+        """Test that measuring fails when the cold import cached no bytecode."""
+        with tempfile.TemporaryDirectory() as output_dir:
+            os.makedirs(os.path.join(output_dir, "pyaz"))
+            with self.assertRaises(RuntimeError):
+                benchmark_imports.check_bytecode(output_dir)
+
+            os.makedirs(os.path.join(output_dir, "pyaz", "__pycache__"))
+            benchmark_imports.check_bytecode(output_dir)
+
+    @staticmethod
+    def write_package(output_dir, modules):
+        """Write a package of modules given as {relative path: source} under output_dir."""
+        for path, source in modules.items():
+            os.makedirs(os.path.join(output_dir, path), exist_ok=True)
+            with open(os.path.join(output_dir, path, "__init__.py"), "w", encoding="utf-8") as file:
+                file.write(source)
+
+    def test_measure(self):
+        """Test measuring the import cost of a small generated package."""
+        with tempfile.TemporaryDirectory() as output_dir:
+            self.write_package(output_dir, {
+                "pyaz": "from . import group, small\n",
+                os.path.join("pyaz", "group"): "TABLE = [str(i) for i in range(100000)]\n",
+                os.path.join("pyaz", "small"): "",
+            })
+
+            # the warm imports need the bytecode even when it isn't written by default
+            with mock.patch.dict(os.environ, PYTHONDONTWRITEBYTECODE="1"):
+                results = benchmark_imports.measure(output_dir, repeat=1)
+
+        self.assertEqual(["pyaz", "pyaz.group", "pyaz.small"], list(results))
+        self.assertEqual(1, results["pyaz.group"]["files"])
+        self.assertGreater(results["pyaz"]["warm_import_seconds"], 0)
+        self.assertGreater(results["pyaz"]["memory_bytes"], 0)
+        self.assertIn("pyaz.group", [name for name, _ in results["pyaz"]["slowest_modules"]])
+
+        # the groups are measured by their own share of the import of pyaz
+        self.assertGreater(results["pyaz.group"]["memory_bytes"], 1_000_000)
+        self.assertLess(results["pyaz.small"]["memory_bytes"], 10_000)
+        self.assertLess(
+            results["pyaz.small"]["warm_import_seconds"],
+            results["pyaz.group"]["warm_import_seconds"],
+        )
+
+    def test_measure_lazy_imports(self):
+        """Test that groups pyaz doesn't import up front are measured on their own."""
+        with tempfile.TemporaryDirectory() as output_dir:
+            self.write_package(output_dir, {
+                "pyaz": "TABLE = [str(i) for i in range(100000)]\n",
+                os.path.join("pyaz", "small"): "",
+            })
+
+            with mock.patch.object(
+                benchmark_imports, "run_imports", wraps=benchmark_imports.run_imports
+            ) as run_imports:
+                results = benchmark_imports.measure(output_dir, repeat=1)
+
+        self.assertEqual(
+            ["pyaz", "pyaz.small"], [call.args[1] for call in run_imports.call_args_list]
+        )
+        self.assertLess(results["pyaz.small"]["memory_bytes"], 10_000)
+        self.assertLess(
+            results["pyaz.small"]["warm_import_seconds"],
+            results["pyaz"]["warm_import_seconds"],
+        )
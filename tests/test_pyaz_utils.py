@@ -1,5 +1,19 @@
-"""Tests for pyaz_utils module."""
+"""Tests for pyaz_utils module."""  # pylint: disable=too-many-lines
+import asyncio
+import http.server
+import json
+import os
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
 import unittest
+import urllib.parse
+from unittest import mock
 import pyaz_utils
 
 
@@ -48,3 +62,1027 @@ class TestUnit(unittest.TestCase):
         ]
         actual = pyaz_utils._get_params(params)
         self.assertEqual(expected, actual)
+
+    def test_get_doc(self):
+        """Test that the docstring is returned for functions that have one."""
+        self.assertEqual(pyaz_utils._call_az.__doc__, pyaz_utils.get_doc(pyaz_utils._call_az))
+
+    def test_get_doc_from_help_index(self):
+        """Test that the help of a function without a docstring is read from the help index."""
+        pyaz_utils._load_help_index.cache_clear()
+        pyaz_utils._load_help_index()["pyaz_utils.lean_function"] = "help from the index"
+        try:
+            def lean_function():
+                pass
+            lean_function.__module__ = "pyaz_utils"
+            self.assertEqual("help from the index", pyaz_utils.get_doc(lean_function))
+        finally:
+            pyaz_utils._load_help_index.cache_clear()
+
+
+class TestDispatch(unittest.TestCase):
+    """Unit tests for calling commands by name through the dispatch index."""
+
+    # pylint: disable=protected-access
+
+    def setUp(self):
+        pyaz_utils._load_dispatch_index.cache_clear()
+        pyaz_utils._load_dispatch_index()["group show"] = {
+            "command": "group show",
+            "module": "pyaz.group",
+            "function": "show",
+            "arguments": [["name", "--name", True], ["subscription", "--subscription", False]],
+            "options": {},
+        }
+        self.transport = FakeTransport(stdout='{"name": "test"}')
+        self.previous = pyaz_utils.set_transport(self.transport)
+
+    def tearDown(self):
+        pyaz_utils.set_transport(self.previous)
+        pyaz_utils._load_dispatch_index.cache_clear()
+
+    def test_call(self):
+        """Test that a command is called by name with the arguments in signature order."""
+        result = pyaz_utils.call("az group show", subscription="sub", name="test")
+
+        self.assertEqual({"name": "test"}, result)
+        self.assertEqual(
+            [["az", "group", "show", "--name", "test", "--subscription", "sub"]],
+            self.transport.calls,
+        )
+
+    def test_call_unknown_command(self):
+        """Test that calling an unknown command raises ValueError."""
+        with self.assertRaises(ValueError):
+            pyaz_utils.call("group shows", name="test")
+
+    def test_call_invalid_arguments(self):
+        """Test that arguments are checked against the signature before running az."""
+        with self.assertRaises(TypeError):
+            pyaz_utils.call("group show", name="test", nme="test")
+        with self.assertRaises(TypeError):
+            pyaz_utils.call("group show", subscription="sub")
+        self.assertEqual([], self.transport.calls)
+
+    def test_lazy_subcommands(self):
+        """Test that subcommands are imported on first access."""
+        getattr_, dir_ = pyaz_utils._lazy_subcommands("json", ["decoder"])
+        self.assertEqual("json.decoder", getattr_("decoder").__name__)
+        self.assertIn("decoder", dir_())
+        with self.assertRaises(AttributeError):
+            getattr_("missing")
+
+
+class TestValidation(unittest.TestCase):
+    """Unit tests for checking parameters against validation rules before running az."""
+
+    # pylint: disable=protected-access
+
+    RULES = {
+        "az vm create": {
+            "required": ["name"],
+            "arguments": {
+                "priority": {"choices": ["Regular", "Low", "Spot"]},
+                "count": {"type": "int"},
+                "zone": {},
+                "nics": {"nargs": "+"},
+            },
+        },
+        "az ext show": {
+            "required": [],
+            "arguments": {"kind": {"choices": ["a"]}},
+            "extension": "loose-extension",
+        },
+    }
+
+    def setUp(self):
+        self.transport = FakeTransport(stdout='{"name": "test"}')
+        self.previous = pyaz_utils.set_transport(self.transport)
+
+    def tearDown(self):
+        pyaz_utils.set_transport(self.previous)
+        pyaz_utils.enable_validation()
+
+    def call_az(self, command, parameters):
+        """Call az like the generated function of the command, passing its rules."""
+        return pyaz_utils._call_az(command, parameters, validation=self.RULES[command])
+
+    def test_valid(self):
+        """Test that valid parameters, choices matched regardless of case, call az."""
+        parameters = {"name": "vm", "priority": "spot", "count": "2", "nics": ["a", "b"]}
+        self.call_az("az vm create", parameters)
+        self.assertEqual(1, len(self.transport.calls))
+
+    def test_invalid(self):
+        """Test that invalid parameters raise ValueError without running az."""
+        for parameters, message in [
+            ({"name": None}, "missing required arguments: name"),
+            ({"name": "vm", "priority": "Spott"}, "invalid choice 'Spott'"),
+            ({"name": "vm", "count": "two"}, "expects an int value"),
+            ({"name": "vm", "zone": ["1", "2"]}, "takes a single value"),
+        ]:
+            with self.assertRaisesRegex(ValueError, message):
+                self.call_az("az vm create", parameters)
+        self.assertEqual([], self.transport.calls)
+
+    def test_no_rules(self):
+        """Test that commands without rules call az unchecked."""
+        pyaz_utils._call_az("az vm create", {"name": None})
+        self.assertEqual(1, len(self.transport.calls))
+
+    def test_disable_validation(self):
+        """Test that validation can be disabled entirely or for an extension's commands."""
+        pyaz_utils.disable_validation(extensions=["loose-extension"])
+        self.call_az("az ext show", {"kind": "b"})
+        with self.assertRaises(ValueError):
+            self.call_az("az vm create", {"name": "vm", "priority": "Spott"})
+
+        pyaz_utils.disable_validation()
+        self.call_az("az vm create", {"name": "vm", "priority": "Spott"})
+        self.assertEqual(2, len(self.transport.calls))
+
+
+class FakeTransport:
+    """Transport returning a canned response, standing in for az."""
+
+    def __init__(self, stdout="", stderr="", returncode=0):
+        self.stdout = stdout
+        self.stderr = stderr
+        self.returncode = returncode
+        self.calls = []
+
+    def run(self, argv, deadline=None):  # pylint: disable=unused-argument
+        """Return the canned response and remember the argv."""
+        self.calls.append(list(argv))
+        return subprocess.CompletedProcess(
+            list(argv),
+            self.returncode,
+            stdout=self.stdout.encode("utf-8"),
+            stderr=self.stderr.encode("utf-8"),
+        )
+
+
+class TestTransport(unittest.TestCase):
+    """Unit tests for the record and replay transports."""
+
+    # pylint: disable=protected-access
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.cassette = os.path.join(self.directory.name, "cassette.jsonl")
+        self.previous = pyaz_utils._transport
+
+    def tearDown(self):
+        pyaz_utils.set_transport(self.previous)
+        self.directory.cleanup()
+
+    def test_record(self):
+        """Test that calls are recorded into the cassette file."""
+        fake = FakeTransport(stdout='{"name": "test"}')
+        pyaz_utils.set_transport(pyaz_utils.RecordingTransport(self.cassette, fake))
+
+        result = pyaz_utils._call_az("az group show", {"name": "test"})
+        self.assertEqual({"name": "test"}, result)
+        self.assertEqual([["az", "group", "show", "--name", "test"]], fake.calls)
+
+        with open(self.cassette, encoding="utf-8") as file:
+            interaction = json.loads(file.readline())
+        self.assertEqual(["az", "group", "show", "--name", "test"], interaction["argv"])
+        self.assertEqual('{"name": "test"}', interaction["stdout"])
+        self.assertEqual(0, interaction["returncode"])
+        self.assertIn("duration", interaction)
+
+    def test_replay(self):
+        """Test that recorded calls are served back without running az."""
+        pyaz_utils.set_transport(
+            pyaz_utils.RecordingTransport(self.cassette, FakeTransport(stdout='{"a": 1}'))
+        )
+        pyaz_utils._call_az("az version", {})
+        pyaz_utils.set_transport(
+            pyaz_utils.RecordingTransport(self.cassette, FakeTransport(stdout='{"a": 2}'))
+        )
+        pyaz_utils._call_az("az version", {})
+
+        pyaz_utils.set_transport(pyaz_utils.ReplayTransport(self.cassette))
+        self.assertEqual({"a": 1}, pyaz_utils._call_az("az version", {}))
+        self.assertEqual({"a": 2}, pyaz_utils._call_az("az version", {}))
+        # once exhausted the last response keeps being served
+        self.assertEqual({"a": 2}, pyaz_utils._call_az("az version", {}))
+
+    def test_replay_error(self):
+        """Test that a recorded failure is raised again on replay."""
+        pyaz_utils.set_transport(
+            pyaz_utils.RecordingTransport(
+                self.cassette, FakeTransport(stderr="not found", returncode=3)
+            )
+        )
+        with self.assertRaises(subprocess.CalledProcessError):
+            pyaz_utils._call_az("az group show", {"name": "missing"})
+
+        pyaz_utils.set_transport(pyaz_utils.ReplayTransport(self.cassette))
+        with self.assertRaises(subprocess.CalledProcessError) as context:
+            pyaz_utils._call_az("az group show", {"name": "missing"})
+        self.assertEqual(3, context.exception.returncode)
+        self.assertEqual(b"not found", context.exception.stderr)
+
+    def test_replay_unrecorded(self):
+        """Test that replaying a command that wasn't recorded raises LookupError."""
+        open(self.cassette, mode="w", encoding="utf-8").close()  # pylint: disable=consider-using-with
+        pyaz_utils.set_transport(pyaz_utils.ReplayTransport(self.cassette))
+        with self.assertRaises(LookupError):
+            pyaz_utils._call_az("az version", {})
+
+    def test_replay_latency(self):
+        """Test that the recorded latency is reproduced when asked for."""
+        interaction = {
+            "argv": ["az", "version"],
+            "stdout": "{}",
+            "stderr": "",
+            "returncode": 0,
+            "duration": 0.2,
+        }
+        with open(self.cassette, mode="w", encoding="utf-8") as file:
+            file.write(json.dumps(interaction) + "\n")
+
+        pyaz_utils.set_transport(pyaz_utils.ReplayTransport(self.cassette))
+        start = time.perf_counter()
+        pyaz_utils._call_az("az version", {})
+        self.assertLess(time.perf_counter() - start, 0.2)
+
+        pyaz_utils.set_transport(pyaz_utils.ReplayTransport(self.cassette, latency=True))
+        start = time.perf_counter()
+        pyaz_utils._call_az("az version", {})
+        self.assertGreaterEqual(time.perf_counter() - start, 0.2)
+
+    def test_record_redacts_secrets(self):
+        """Test that secret arguments and output fields are redacted, and still replay."""
+        token = '{"accessToken": "eyJ0", "tokenType": "Bearer", "tenant": "t"}'
+        pyaz_utils.set_transport(
+            pyaz_utils.RecordingTransport(self.cassette, FakeTransport(stdout=token))
+        )
+        pyaz_utils._call_az(
+            "az vm create", {"name": "vm", "admin_password": "P@ss", "generate_ssh_keys": True}
+        )
+        pyaz_utils._call_az("az account get-access-token", {})
+
+        with open(self.cassette, encoding="utf-8") as file:
+            interactions = [json.loads(line) for line in file]
+        self.assertEqual(
+            ["az", "vm", "create", "--name", "vm", "--admin-password", "<redacted>",
+             "--generate-ssh-keys"],
+            interactions[0]["argv"],
+        )
+        self.assertEqual(
+            {"accessToken": "<redacted>", "tokenType": "Bearer", "tenant": "t"},
+            json.loads(interactions[1]["stdout"]),
+        )
+        self.assertNotIn("P@ss", json.dumps(interactions))
+
+        pyaz_utils.set_transport(pyaz_utils.ReplayTransport(self.cassette))
+        pyaz_utils._call_az(
+            "az vm create", {"name": "vm", "admin_password": "other", "generate_ssh_keys": True}
+        )
+
+    def test_record_without_redaction(self):
+        """Test that redaction can be turned off."""
+        pyaz_utils.set_transport(
+            pyaz_utils.RecordingTransport(self.cassette, FakeTransport(), redact=False)
+        )
+        pyaz_utils._call_az("az vm create", {"admin_password": "P@ss"})
+        with open(self.cassette, encoding="utf-8") as file:
+            self.assertIn("P@ss", file.read())
+
+    def test_transport_from_env(self):
+        """Test that the transport is chosen by the environment, rejecting invalid settings."""
+        open(self.cassette, mode="w", encoding="utf-8").close()  # pylint: disable=consider-using-with
+        for environ, expected in [
+            ({"PYAZ_TRANSPORT": "subprocess"}, pyaz_utils.SubprocessTransport),
+            ({"PYAZ_TRANSPORT": "record", "PYAZ_CASSETTE": self.cassette},
+             pyaz_utils.RecordingTransport),
+            ({"PYAZ_TRANSPORT": "replay", "PYAZ_CASSETTE": self.cassette},
+             pyaz_utils.ReplayTransport),
+        ]:
+            with mock.patch.dict(os.environ, environ):
+                self.assertIsInstance(pyaz_utils._get_transport_from_env(), expected)
+
+        for environ in [
+            {"PYAZ_TRANSPORT": "Replay", "PYAZ_CASSETTE": self.cassette},
+            {"PYAZ_TRANSPORT": "replay", "PYAZ_CASSETTE": ""},
+        ]:
+            with mock.patch.dict(os.environ, environ), self.assertRaises(ValueError):
+                pyaz_utils._get_transport_from_env()
+
+
+class ShowTransport:
+    """Transport answering show calls with one resource per id, standing in for az."""
+
+    def __init__(self, returncode=0, delay=0):
+        self.returncode = returncode
+        self.delay = delay  # seconds taken by each call unless its deadline expires
+        self.calls = []
+        self.expired = []  # whether the deadline of each call expired
+        self.lock = threading.Lock()
+
+    def run(self, argv, deadline=None):
+        """Return the resources for the ids in argv."""
+        with self.lock:
+            self.calls.append(list(argv))
+        if self.delay:
+            pyaz_utils._wait(threading.Event(), self.delay, deadline)  # pylint: disable=protected-access
+            self.expired.append(deadline is not None and deadline.expired)
+            if deadline is not None and deadline.expired:
+                raise deadline.get_error(argv, b"")
+        ids = argv[argv.index("--ids") + 1:]
+        resources = [{"id": id_.upper(), "name": id_.rsplit("/", 1)[-1]} for id_ in ids]
+        output = resources[0] if len(resources) == 1 else resources
+        return subprocess.CompletedProcess(
+            list(argv),
+            self.returncode,
+            stdout=json.dumps(output).encode("utf-8"),
+            stderr=b"",
+        )
+
+
+class TestIdsBatching(unittest.TestCase):
+    """Unit tests for batching calls with ids."""
+
+    # pylint: disable=protected-access,unsubscriptable-object
+
+    def setUp(self):
+        self.transport = ShowTransport()
+        self.previous = pyaz_utils.set_transport(self.transport)
+
+    def tearDown(self):
+        pyaz_utils.set_transport(self.previous)
+        pyaz_utils.disable_ids_batching()
+
+    def call_concurrently(self, ids, parameters=None, command="az resource show"):
+        """Call the command with each id in its own thread and return the results."""
+        results = [None] * len(ids)
+
+        def show(index):
+            try:
+                results[index] = pyaz_utils._call_az(
+                    command,
+                    dict(parameters or {}, ids=ids[index]),
+                    ids_batchable=True,
+                )
+            except subprocess.CalledProcessError as error:
+                results[index] = error
+
+        threads = [threading.Thread(target=show, args=(i,)) for i in range(len(ids))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_get_params_with_multiple_ids(self):
+        """Test that multiple ids are passed as separate values."""
+        self.assertEqual(
+            ["--ids", '"/a"', '"/b"'], pyaz_utils._get_params({"ids": "/a /b"})
+        )
+        self.assertEqual(
+            ["--ids", '"/a"', '"/b"'], pyaz_utils._get_params({"ids": ["/a", "/b"]})
+        )
+
+    def test_batching_disabled(self):
+        """Test that calls aren't batched unless batching is enabled."""
+        self.call_concurrently(["/r/a", "/r/b"])
+        self.assertEqual(2, len(self.transport.calls))
+
+    def test_batching(self):
+        """Test that concurrent calls are merged and the output split back."""
+        pyaz_utils.enable_ids_batching(window=0.5)
+        results = self.call_concurrently(["/r/a", "/r/b", "/r/c"])
+
+        self.assertEqual(1, len(self.transport.calls))
+        self.assertEqual(["a", "b", "c"], [result["name"] for result in results])
+
+    def test_batching_max_batch_size(self):
+        """Test that a full batch runs without waiting for the window."""
+        pyaz_utils.enable_ids_batching(window=10, max_batch_size=2)
+        start = time.perf_counter()
+        results = self.call_concurrently(["/r/a", "/r/b"])
+
+        self.assertLess(time.perf_counter() - start, 10)
+        self.assertEqual(["a", "b"], [result["name"] for result in results])
+
+    def test_batching_only_ids(self):
+        """Test that calls with parameters other than ids aren't batched."""
+        pyaz_utils.enable_ids_batching(window=0.5)
+        self.call_concurrently(["/r/a", "/r/b"], {"subscription": "sub"})
+        self.assertEqual(2, len(self.transport.calls))
+
+    def test_batching_failure(self):
+        """Test that each caller falls back to its own call when the batch fails."""
+        self.transport.returncode = 1
+        pyaz_utils.enable_ids_batching(window=0.5)
+
+        with self.assertRaises(subprocess.CalledProcessError):
+            pyaz_utils._call_az("az resource show", {"ids": "/r/a"}, ids_batchable=True)
+
+        results = self.call_concurrently(["/r/a", "/r/b"])
+        self.assertIsInstance(results[0], subprocess.CalledProcessError)
+        # one failed batch call then one call for each caller
+        self.assertEqual(4, len(self.transport.calls))
+
+    def test_batching_leader_deadline(self):
+        """Test that the leader of a batch gives up at its own deadline, not the batch's."""
+        self.transport.delay = 1
+        pyaz_utils.enable_ids_batching(window=0.2)
+        results = {}
+
+        def show(name, timeout):
+            start = time.perf_counter()
+            try:
+                with pyaz_utils.deadline_scope(timeout):
+                    results[name] = pyaz_utils._call_az(
+                        "az resource show", {"ids": f"/r/{name}"}, ids_batchable=True
+                    )
+            except pyaz_utils.AzTimeoutError as error:
+                results[name] = error
+            results[name + "_seconds"] = time.perf_counter() - start
+
+        leader = threading.Thread(target=show, args=("a", 0.4))
+        follower = threading.Thread(target=show, args=("b", None))
+        leader.start()
+        time.sleep(0.05)
+        follower.start()
+        leader.join()
+        follower.join()
+
+        self.assertIsInstance(results["a"], pyaz_utils.AzTimeoutError)
+        self.assertLess(results["a_seconds"], 0.9)
+        self.assertEqual("b", results["b"]["name"])
+        self.assertEqual(1, len(self.transport.calls))
+
+    def test_batching_leader_cancelled(self):
+        """Test that cancelling the leader is honoured, and cancels the abandoned batch."""
+        self.transport.delay = 2
+        pyaz_utils.enable_ids_batching(window=0.05)
+
+        start = time.perf_counter()
+        with self.assertRaises(pyaz_utils.AzCancelledError):
+            with pyaz_utils.deadline_scope() as scope:
+                threading.Timer(0.2, scope.cancel).start()
+                pyaz_utils._call_az("az resource show", {"ids": "/r/a"}, ids_batchable=True)
+        self.assertLess(time.perf_counter() - start, 1)
+
+        wait_until = time.monotonic() + 2
+        while not self.transport.expired and time.monotonic() < wait_until:
+            time.sleep(0.01)
+        self.assertEqual([True], self.transport.expired)
+
+    def test_batching_follower_left_in_window(self):
+        """Test that a caller giving up in the batch window is left out of the batch."""
+        self.transport.delay = 3
+        pyaz_utils.enable_ids_batching(window=0.5)
+        results = {}
+        scopes = {}
+
+        def show(name, timeout):
+            try:
+                with pyaz_utils.deadline_scope(timeout) as scope:
+                    scopes[name] = scope
+                    results[name] = pyaz_utils._call_az(
+                        "az resource show", {"ids": f"/r/{name}"}, ids_batchable=True
+                    )
+            except pyaz_utils.AzTimeoutError as error:
+                results[name] = error
+
+        # the leader has no expiry and is cancelled after the follower left
+        leader = threading.Thread(target=show, args=("a", None))
+        follower = threading.Thread(target=show, args=("b", 0.1))
+        leader.start()
+        time.sleep(0.05)
+        follower.start()
+        follower.join()
+        self.assertIsInstance(results["b"], pyaz_utils.AzTimeoutError)
+
+        time.sleep(0.7)
+        scopes["a"].cancel()
+        leader.join()
+        self.assertIsInstance(results["a"], pyaz_utils.AzCancelledError)
+
+        # the batch only ran with the leader's ids, and was cancelled once it left
+        self.assertEqual(["--ids", "/r/a"], self.transport.calls[0][-2:])
+        wait_until = time.monotonic() + 1
+        while not self.transport.expired and time.monotonic() < wait_until:
+            time.sleep(0.01)
+        self.assertEqual([True], self.transport.expired)
+
+    def test_batching_delete_failure(self):
+        """Test that a failed batch delete is raised to every caller without retrying."""
+        self.transport.returncode = 1
+        pyaz_utils.enable_ids_batching(window=0.5)
+
+        results = self.call_concurrently(["/r/a", "/r/b"], command="az resource delete")
+        for result in results:
+            self.assertIsInstance(result, subprocess.CalledProcessError)
+        self.assertEqual(1, len(self.transport.calls))
+
+
+# script for python run as az that starts a child process and hangs
+HANG_SCRIPT = """
+import subprocess, sys, time
+child = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(60)"])
+print(f"child {child.pid}", file=sys.stderr, flush=True)
+time.sleep(60)
+"""
+
+
+def is_alive(pid):
+    """Return whether the process is running, zombies count as dead."""
+    try:
+        with open(f"/proc/{pid}/stat", encoding="utf-8") as file:
+            return file.read().rsplit(")", 1)[1].split()[0] not in ("Z", "X")
+    except FileNotFoundError:
+        return False
+
+
+@unittest.skipUnless(os.path.isdir("/proc"), "needs /proc to check the processes")
+class TestDeadline(unittest.TestCase):
+    """Unit tests for deadlines, timeouts and cancellation of az calls."""
+
+    # pylint: disable=protected-access
+
+    def setUp(self):
+        self.transport = pyaz_utils.SubprocessTransport(executable=sys.executable)
+
+    def tearDown(self):
+        pyaz_utils.set_default_timeout(None)
+
+    def assert_killed(self, error):
+        """Assert that the child started by the hanging script was killed."""
+        pid = int(error.stderr.split()[1])
+        for _ in range(100):
+            if not is_alive(pid):
+                break
+            time.sleep(0.05)
+        self.assertFalse(is_alive(pid), "child process of az is still running")
+
+    def test_no_deadline(self):
+        """Test that the command runs to completion without a deadline."""
+        output = self.transport.run(["az", "-c", "print('{}')"])
+        self.assertEqual(0, output.returncode)
+        self.assertEqual(b"{}", output.stdout.strip())
+
+    def test_timeout(self):
+        """Test that the process group is killed when the deadline passes."""
+        start = time.perf_counter()
+        with pyaz_utils.deadline_scope(0.5) as scope:
+            with self.assertRaises(pyaz_utils.AzTimeoutError) as context:
+                self.transport.run(["az", "-c", HANG_SCRIPT], scope)
+
+        self.assertLess(time.perf_counter() - start, 10)
+        self.assertNotIsInstance(context.exception, pyaz_utils.AzCancelledError)
+        self.assertIn("child", context.exception.stderr)
+        self.assert_killed(context.exception)
+
+    def test_cancel_from_thread(self):
+        """Test that cancelling the deadline from another thread kills the call."""
+        with pyaz_utils.deadline_scope() as scope:
+            threading.Timer(0.5, scope.cancel).start()
+            with self.assertRaises(pyaz_utils.AzCancelledError) as context:
+                self.transport.run(["az", "-c", HANG_SCRIPT], scope)
+
+        self.assert_killed(context.exception)
+
+    def test_cancel_asyncio_task(self):
+        """Test that cancelling the asyncio task running the call kills it."""
+        errors = []
+
+        def hang():
+            try:
+                self.transport.run(["az", "-c", HANG_SCRIPT], pyaz_utils._get_call_deadline())
+            except pyaz_utils.AzCancelledError as error:
+                errors.append(error)
+
+        async def main():
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(pyaz_utils.run_async(hang), 0.5)
+
+        asyncio.run(main())
+        self.assertEqual(1, len(errors))
+        self.assert_killed(errors[0])
+
+    def test_nested_deadline(self):
+        """Test that a nested deadline expires no later than its parent and is cancelled with it."""
+        with pyaz_utils.deadline_scope(1) as parent:
+            with pyaz_utils.deadline_scope(60) as child:
+                self.assertLessEqual(child.expires, parent.expires)
+                parent.cancel()
+                self.assertTrue(child.expired)
+
+    def test_default_timeout(self):
+        """Test that the default timeout applies to each call."""
+        directory = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(directory.cleanup)
+        cassette = os.path.join(directory.name, "cassette.jsonl")
+        with open(cassette, mode="w", encoding="utf-8") as file:
+            interaction = {
+                "argv": ["az", "version"],
+                "stdout": "{}",
+                "stderr": "",
+                "returncode": 0,
+                "duration": 30,
+            }
+            file.write(json.dumps(interaction) + "\n")
+
+        previous = pyaz_utils.set_transport(pyaz_utils.ReplayTransport(cassette, latency=True))
+        self.addCleanup(pyaz_utils.set_transport, previous)
+        pyaz_utils.set_default_timeout(0.2)
+
+        start = time.perf_counter()
+        with self.assertRaises(pyaz_utils.AzTimeoutError):
+            pyaz_utils._call_az("az version", {})
+        self.assertLess(time.perf_counter() - start, 5)
+
+
+SUBSCRIPTION = "00000000-0000-0000-0000-000000000000"
+GROUP_ID = f"/subscriptions/{SUBSCRIPTION}/resourceGroups/test"
+VM_ID = f"{GROUP_ID}/providers/Microsoft.Compute/virtualMachines/vm"
+
+
+class ArmHandler(http.server.BaseHTTPRequestHandler):
+    """Request handler playing the part of ARM."""
+
+    protocol_version = "HTTP/1.1"  # keep connections alive
+    requests = []
+    clients = set()
+    routes = {
+        f"/subscriptions/{SUBSCRIPTION}/resourcegroups/test": {
+            "id": GROUP_ID,
+            "name": "test",
+            "type": "Microsoft.Resources/resourceGroups",
+            "location": "eastus",
+            "properties": {"provisioningState": "Succeeded"},
+        },
+        f"/subscriptions/{SUBSCRIPTION}/resources": {
+            "value": [{"id": VM_ID, "name": "vm"}],
+            "nextLink": f"http://localhost/subscriptions/{SUBSCRIPTION}/resources?page=2",
+        },
+        f"/subscriptions/{SUBSCRIPTION}/resources?page=2": {
+            "value": [{"id": f"{VM_ID}2", "name": "vm2"}]
+        },
+        f"/subscriptions/{SUBSCRIPTION}/providers/Microsoft.Compute": {
+            "resourceTypes": [
+                {
+                    "resourceType": "virtualMachines",
+                    "apiVersions": ["2022-01-01-preview", "2021-11-01"],
+                }
+            ]
+        },
+        VM_ID: {"id": VM_ID, "name": "vm"},
+        f"/subscriptions/{SUBSCRIPTION}/resourcegroups/html": b"<html>maintenance</html>",
+    }
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Serve the route of the request, 404 if there is none."""
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        route = url.path + "".join(f"?page={page}" for page in query.get("page", []))
+        ArmHandler.requests.append((
+            route,
+            query["api-version"][0],
+            self.headers["Authorization"],
+            query.get("$expand", [None])[0],
+        ))
+        ArmHandler.clients.add(self.client_address)
+
+        body = self.routes.get(route, {"error": "not found"})
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode("utf-8")
+        self.send_response(200 if route in self.routes else 404)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        """Don't log the requests."""
+
+
+class TestFastPath(unittest.TestCase):
+    """Unit tests for the ARM fast path against a local stand-in for ARM."""
+
+    # pylint: disable=protected-access
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.ThreadingHTTPServer(("localhost", 0), ArmHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        ArmHandler.requests.clear()
+        ArmHandler.clients.clear()
+        self.transport = FakeTransport(stdout='{"from": "az"}')
+        self.previous = pyaz_utils.set_transport(self.transport)
+        pyaz_utils.enable_fast_path(
+            endpoint=f"http://localhost:{self.server.server_address[1]}",
+            token_provider=lambda: "token",
+            subscription=SUBSCRIPTION,
+        )
+
+    def tearDown(self):
+        pyaz_utils.set_transport(self.previous)
+        pyaz_utils.disable_fast_path()
+
+    def test_group_show(self):
+        """Test that group show is served from ARM with a bearer token, shaped like az's."""
+        result = pyaz_utils._call_az("az group show", {"name": "test", "subscription": None})
+
+        self.assertEqual(
+            {
+                "id": GROUP_ID,
+                "location": "eastus",
+                "managedBy": None,
+                "name": "test",
+                "properties": {"provisioningState": "Succeeded"},
+                "tags": None,
+                "type": "Microsoft.Resources/resourceGroups",
+            },
+            result,
+        )
+        self.assertEqual([], self.transport.calls)
+        self.assertEqual("Bearer token", ArmHandler.requests[0][2])
+
+    def test_resource_list(self):
+        """Test that the pages of resource list are collected and resourceGroup added."""
+        result = pyaz_utils._call_az("az resource list", {"resource_group": None})
+
+        self.assertEqual(["vm", "vm2"], [resource["name"] for resource in result])
+        self.assertEqual(["test", "test"], [resource["resourceGroup"] for resource in result])
+
+        # the fields az outputs as null are filled in, with the same properties expanded
+        self.assertIsNone(result[0]["tags"])
+        self.assertEqual(
+            set(pyaz_utils.EXPANDED_RESOURCE_FIELDS) | {"resourceGroup"}, set(result[0])
+        )
+        self.assertEqual(
+            "createdTime,changedTime,provisioningState", ArmHandler.requests[0][3]
+        )
+
+    def test_resource_show(self):
+        """Test that resource show uses the latest stable api version of the resource type."""
+        pyaz_utils._call_az("az resource show", {"ids": VM_ID})
+        result = pyaz_utils._call_az("az resource show", {"ids": VM_ID})
+
+        self.assertEqual("vm", result["name"])
+        self.assertEqual("test", result["resourceGroup"])
+        self.assertIsNone(result["sku"])
+        # the provider's api versions are only fetched once
+        self.assertEqual(3, len(ArmHandler.requests))
+        self.assertEqual("2021-11-01", ArmHandler.requests[-1][1])
+
+    def test_keep_alive(self):
+        """Test that the calls reuse one connection."""
+        for _ in range(3):
+            pyaz_utils._call_az("az group show", {"name": "test"})
+        self.assertEqual(1, len(ArmHandler.clients))
+
+    def test_fallback(self):
+        """Test that calls the fast path can't serve run az."""
+        # not allowlisted
+        self.assertEqual({"from": "az"}, pyaz_utils._call_az("az vm list", {}))
+        # unsupported parameter
+        self.assertEqual(
+            {"from": "az"}, pyaz_utils._call_az("az group list", {"tag": "key=value"})
+        )
+        # subscription by name
+        self.assertEqual(
+            {"from": "az"},
+            pyaz_utils._call_az("az group show", {"name": "test", "subscription": "name"}),
+        )
+        # error response
+        self.assertEqual(
+            {"from": "az"}, pyaz_utils._call_az("az group show", {"name": "missing"})
+        )
+        # response that isn't json
+        self.assertEqual(
+            {"from": "az"}, pyaz_utils._call_az("az group show", {"name": "html"})
+        )
+        self.assertEqual(5, len(self.transport.calls))
+
+    def test_fallback_on_connection_errors(self):
+        """Test that connection, name resolution, ssl and timeout errors fall back to az."""
+        for error in [
+            ConnectionRefusedError(),
+            socket.gaierror(-2, "Name or service not known"),
+            ssl.SSLError(1, "certificate verify failed"),
+            socket.timeout("timed out"),
+        ]:
+            connection = mock.Mock(sock=None)
+            connection.request.side_effect = error
+            with mock.patch.object(
+                pyaz_utils._fast_path, "_get_connection", return_value=connection
+            ):
+                self.assertEqual(
+                    {"from": "az"}, pyaz_utils._call_az("az group show", {"name": "test"})
+                )
+
+    def test_timeout(self):
+        """Test that a request timing out at the deadline of the call raises AzTimeoutError."""
+        connection = mock.Mock(sock=None)
+        connection.request.side_effect = socket.timeout("timed out")
+        with mock.patch.object(pyaz_utils._fast_path, "_get_connection", return_value=connection):
+            with self.assertRaises(pyaz_utils.AzTimeoutError):
+                with pyaz_utils.deadline_scope(10):
+                    pyaz_utils._call_az("az group show", {"name": "test"})
+        self.assertEqual([], self.transport.calls)
+
+    def test_no_time_left(self):
+        """Test that a deadline with no time left raises without a non-blocking request."""
+
+        class NoTimeLeft(pyaz_utils.Deadline):
+            """Deadline not yet expired when checked, with no time left after."""
+
+            expired = False
+
+            def remaining(self):
+                return 0.0
+
+        token = pyaz_utils._deadline.set(NoTimeLeft(10))
+        try:
+            with self.assertRaises(pyaz_utils.AzTimeoutError):
+                pyaz_utils._call_az("az group show", {"name": "test"})
+        finally:
+            pyaz_utils._deadline.reset(token)
+        self.assertEqual([], ArmHandler.requests)
+
+
+class TestCompactResults(unittest.TestCase):
+    """Unit tests for the compact results of list commands."""
+
+    # pylint: disable=protected-access
+
+    RESOURCES = [
+        {"id": "/a", "name": "a", "location": "westus", "tags": {"env": "dev"}},
+        {"id": "/b", "name": "b", "location": "eastus", "sku": {"name": "S1"}},
+    ]
+
+    def setUp(self):
+        self.previous = pyaz_utils._transport
+
+    def tearDown(self):
+        pyaz_utils.set_transport(self.previous)
+        pyaz_utils.disable_compact_results()
+
+    def test_from_json(self):
+        """Test that records read back as dicts, missing fields included."""
+        results = pyaz_utils.CompactList.from_json(json.dumps(self.RESOURCES), ["id", "name"])
+        self.assertEqual(2, len(results))
+        self.assertEqual(self.RESOURCES, results.to_list())
+        self.assertEqual(self.RESOURCES[0], results[0])
+        self.assertEqual(self.RESOURCES[1], results[-1])
+        self.assertNotIn("sku", results[0])
+        self.assertEqual([None, {"name": "S1"}], results.column("sku"))
+        self.assertEqual(["b"], [record["name"] for record in results[1:]])
+
+    def test_lazy_decoding(self):
+        """Test that nested values of fields that aren't eager are kept as json text."""
+        results = pyaz_utils.CompactList.from_json(json.dumps(self.RESOURCES), ["id", "name"])
+        self.assertIsInstance(results._columns["tags"][0], pyaz_utils._JsonText)
+        self.assertEqual({"env": "dev"}, results[0]["tags"])
+
+    def test_where_select(self):
+        """Test filtering and projecting the records."""
+        results = pyaz_utils.CompactList.from_records(self.RESOURCES)
+        filtered = results.where("location", lambda location: location == "eastus")
+        self.assertEqual([{"id": "/b"}], filtered.select("id").to_list())
+
+    def test_invalid_json(self):
+        """Test that json other than an array of objects raises ValueError."""
+        for text in ['{"name": "a"}', "[1, 2]", "[{}"]:
+            with self.assertRaises(ValueError):
+                pyaz_utils.CompactList.from_json(text)
+        self.assertEqual(0, len(pyaz_utils.CompactList.from_json(" [ ] ")))
+
+    def test_call_az(self):
+        """Test that only the output of list commands is compacted when enabled."""
+        pyaz_utils.set_transport(FakeTransport(stdout=json.dumps(self.RESOURCES)))
+        self.assertIsInstance(pyaz_utils._call_az("az resource list", {}), list)
+
+        pyaz_utils.enable_compact_results()
+        result = pyaz_utils._call_az("az resource list", {})
+        self.assertIsInstance(result, pyaz_utils.CompactList)
+        self.assertEqual(self.RESOURCES, result.to_list())
+        self.assertIsInstance(pyaz_utils._call_az("az resource show", {}), list)
+
+    def test_call_az_not_objects(self):
+        """Test that list output that isn't a list of objects is returned as is."""
+        pyaz_utils.enable_compact_results()
+        pyaz_utils.set_transport(FakeTransport(stdout='["a", "b"]'))
+        self.assertEqual(["a", "b"], pyaz_utils._call_az("az resource list", {}))
+
+        fast_path = mock.Mock()
+        fast_path.call.return_value = ["a", {"name": "b"}]
+        with mock.patch.object(pyaz_utils, "_fast_path", fast_path):
+            self.assertEqual(
+                ["a", {"name": "b"}], pyaz_utils._call_az("az resource list", {})
+            )
+            fast_path.call.return_value = [{"name": "a"}]
+            self.assertIsInstance(
+                pyaz_utils._call_az("az resource list", {}), pyaz_utils.CompactList
+            )
+
+    def test_memory(self):
+        """Test that the compact results use less memory than a list of dicts."""
+        resources = [
+            {
+                "id": f"/subscriptions/0/resourceGroups/rg/providers/vm/{index}",
+                "name": f"vm{index}",
+                "location": "westus",
+                "type": "Microsoft.Compute/virtualMachines",
+                "tags": {"env": "dev"},
+                "properties": {"provisioningState": "Succeeded", "index": index},
+            }
+            for index in range(2000)
+        ]
+        text = json.dumps(resources)
+
+        def traced_size(function):
+            tracemalloc.start()
+            result = function()
+            size, _ = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            self.assertEqual(2000, len(result))
+            return size
+
+        compact = traced_size(lambda: pyaz_utils.CompactList.from_json(text, ["id", "name"]))
+        self.assertLess(compact, traced_size(lambda: json.loads(text)))
+
+
+class PagingTransport:
+    """Transport answering list calls a page at a time with the next marker, standing in for az."""
+
+    def __init__(self, total=5):
+        self.total = total
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def run(self, argv, deadline=None):  # pylint: disable=unused-argument
+        """Return the page of items starting at the marker."""
+        with self.lock:
+            self.calls.append(list(argv))
+        start = int(argv[argv.index("--marker") + 1]) if "--marker" in argv else 0
+        size = int(argv[argv.index("--num-results") + 1])
+        output = [{"name": str(index)} for index in range(start, min(start + size, self.total))]
+        if start + size < self.total and "--show-next-marker" in argv:
+            output.append({"nextMarker": str(start + size)})
+        return subprocess.CompletedProcess(
+            list(argv), 0, stdout=json.dumps(output).encode("utf-8"), stderr=b""
+        )
+
+
+class TestPagination(unittest.TestCase):
+    """Unit tests for the iter_ functions of pageable commands."""
+
+    # pylint: disable=protected-access
+
+    def setUp(self):
+        self.previous = pyaz_utils._transport
+        self.transport = PagingTransport()
+        pyaz_utils.set_transport(self.transport)
+
+    def tearDown(self):
+        pyaz_utils.set_transport(self.previous)
+        pyaz_utils.set_default_page_size(1000)
+        pyaz_utils.disable_compact_results()
+
+    def test_iter_pages(self):
+        """Test that all the results are yielded following the markers."""
+        results = pyaz_utils._call_az(
+            "az storage blob list", {"container_name": "c", "page_size": 2}, paginate=True
+        )
+        self.assertEqual([str(index) for index in range(5)], [item["name"] for item in results])
+        self.assertEqual(3, len(self.transport.calls))
+        self.assertEqual(
+            ["az", "storage", "blob", "list", "--container-name", "c",
+             "--num-results", "2", "--show-next-marker", "--marker", "4"],
+            self.transport.calls[-1],
+        )
+
+    def test_prefetch(self):
+        """Test that the next page is fetched while the current one is consumed."""
+        results = pyaz_utils._call_az("az storage blob list", {"page_size": 2}, paginate=True)
+        self.assertEqual({"name": "0"}, next(results))
+
+        start = time.monotonic()
+        while len(self.transport.calls) < 2 and time.monotonic() - start < 5:
+            time.sleep(0.01)
+        self.assertEqual(2, len(self.transport.calls))
+
+    def test_default_page_size(self):
+        """Test that the default page size applies when none is given, with compact results."""
+        pyaz_utils.set_default_page_size(3)
+        pyaz_utils.enable_compact_results()
+        results = list(pyaz_utils._call_az("az storage blob list", {}, paginate=True))
+        self.assertEqual(5, len(results))
+        self.assertEqual(2, len(self.transport.calls))
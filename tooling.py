@@ -81,6 +81,26 @@ def arguments_loaded(command_name):
     return ARGUMENTS_LOADED.get(command_name, False)
 
 
+def release_command(command_name):
+    ARGUMENTS_LOADED.pop(command_name, None)
+    HELP_CACHE.pop(command_name, None)
+
+    # drop the command from the shared command table so later argument loads don't revisit it
+    commands_loader = cli_ctx.invocation.commands_loader
+    commands_loader.cmd_to_loader_map.pop(command_name, None)
+    command = commands_loader.command_table.pop(command_name, None)
+    if command is not None:
+        command.arguments = {}
+
+
+def release_arguments():
+    # the main loader merges the argument registries of each loader it loads arguments
+    # with, clear them so they don't grow group by group, they're merged again on each load
+    commands_loader = cli_ctx.invocation.commands_loader
+    commands_loader.argument_registry.arguments.clear()
+    commands_loader.extra_argument_registry.clear()
+
+
 def load_arguments(cmd_table, batch):
     for command in cmd_table:
         if not ARGUMENTS_LOADED.get(command):
@@ -104,6 +124,10 @@ def get_help(group_or_command):
     return HELP_CACHE.get(group_or_command)
 
 
+def release_help(group_or_command):
+    HELP_CACHE.pop(group_or_command, None)
+
+
 def get_current_subscription():
     try:
         profile = Profile(cli_ctx=cli_ctx)